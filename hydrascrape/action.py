@@ -5,11 +5,13 @@
 """
 Action script for hydra scraper
 """
+
 import json
 import os
-import re
 import subprocess
 import sys
+import threading
+from concurrent.futures import ThreadPoolExecutor
 
 
 def perror(txt, code=1):
@@ -22,30 +24,160 @@ def perror(txt, code=1):
     sys.exit(code)
 
 
+def copy_jobs() -> int:
+    """Get maximum number of concurrent nix copy invocations
+
+    @return: value of ACTION_JOBS, 4 by default
+    """
+    try:
+        return max(int(os.getenv("ACTION_JOBS", "4")), 1)
+    except ValueError:
+        print(
+            f"Warning: Invalid ACTION_JOBS: {os.getenv('ACTION_JOBS')}",
+            file=sys.stderr,
+        )
+    return 4
+
+
+# Limits all nix invocations, from whichever thread, to ACTION_JOBS at a time
+nix_jobs = copy_jobs()
+nix_slots = threading.BoundedSemaphore(nix_jobs)
+
+
+def run_nix(cmd: list[str], **kwargs) -> subprocess.CompletedProcess:
+    """Runs a nix command once there are less than ACTION_JOBS running
+
+    @param cmd: command and its arguments
+    @param kwargs: further arguments of subprocess.run
+
+    @return: completed process
+    """
+    with nix_slots:
+        return subprocess.run(cmd, check=False, **kwargs)
+
+
+# Index of store paths known to be valid in local store
+present = set()
+
+
+def missing_paths(paths: list[str], derivation: bool = False) -> list[str]:
+    """Get paths which are not present in local store yet
+
+    Paths which do not exist are missing for sure, existing ones are checked
+    to be valid with a local nix path-info, which does not contact the cache.
+
+    @param paths: store paths
+    @param derivation: paths are derivations
+
+    @return: list of missing paths, in order of paths
+    """
+    existing = [p for p in paths if p not in present and os.path.exists(p)]
+    if existing:
+        pathinfo = ["nix", "path-info"]
+        if derivation:
+            pathinfo.append("--derivation")
+        pathinfo.extend(existing)
+        result = run_nix(pathinfo, stdout=subprocess.DEVNULL, stderr=subprocess.DEVNULL)
+        # If some path is not valid, all of them are copied to be sure
+        if result.returncode == 0:
+            present.update(existing)
+
+    return [p for p in paths if p not in present]
+
+
+def copy_paths(cacheurl: str, paths: list[str], derivation: bool = False) -> int:
+    """Copies paths from cache with one nix copy
+
+    @param cacheurl: URL of the binary cache
+    @param paths: store paths to copy
+    @param derivation: copy derivations instead of their outputs
+
+    @return: exit code of nix copy
+    """
+    nixcopy = ["nix", "copy", "--from", cacheurl]
+    if derivation:
+        nixcopy.insert(2, "--derivation")
+
+    nixcopy.extend(paths)
+
+    result = run_nix(nixcopy, stdout=subprocess.PIPE)
+    return result.returncode
+
+
 def nix_copy(
     cacheurl: str,
     paths: list[str],
     derivation: bool = False,
     refresh: bool = False,
-):
-    """Copies stuff from cache"""
+) -> list[tuple[str, int]]:
+    """Copies stuff from cache
+
+    Paths already present in local store are skipped. Other paths are
+    refreshed and copied with single nix invocations. If the copy fails,
+    paths are copied one by one to find out which ones failed, so that the
+    rest of them are still copied.
+
+    @param cacheurl: URL of the binary cache
+    @param paths: store paths to copy
+    @param derivation: copy derivations instead of their outputs
+    @param refresh: refresh cached narinfo of the paths first
+
+    @return: list of (path, exit code) of failed copies, in order of paths
+    """
+    paths = missing_paths(paths, derivation)
     if len(paths) < 1:
-        return
+        return []
 
     if refresh:
         refreshcmd = ["nix", "path-info", "--refresh", "--store", cacheurl]
         refreshcmd.extend(paths)
-        subprocess.run(refreshcmd, stdout=subprocess.PIPE, check=False)
+        run_nix(refreshcmd, stdout=subprocess.PIPE)
+
+    returncode = copy_paths(cacheurl, paths, derivation)
+    if returncode == 0:
+        present.update(paths)
+        return []
+    if len(paths) == 1:
+        return [(paths[0], returncode)]
+
+    # Number of copies actually running is limited by run_nix
+    failed = []
+    with ThreadPoolExecutor(max_workers=nix_jobs) as pool:
+        returncodes = pool.map(lambda p: copy_paths(cacheurl, [p], derivation), paths)
+        for path, returncode in zip(paths, returncodes):
+            if returncode != 0:
+                failed.append((path, returncode))
+            else:
+                present.add(path)
+    return failed
+
+
+def nix_copy_all(cacheurl: str, paths: list[str], drvs: list[str]) -> list:
+    """Refreshes and copies paths and derivations from cache concurrently
+
+    Both share the ACTION_JOBS limit of concurrent nix invocations.
+
+    @param cacheurl: URL of the binary cache
+    @param paths: store paths to copy
+    @param drvs: derivations to copy
+
+    @return: list of (path, exit code) of failed copies, failed paths
+             first, both in the order they were given
+    """
+    with ThreadPoolExecutor(max_workers=1) as pool:
+        drv_copy = pool.submit(nix_copy, cacheurl, drvs, True, True)
+        failed = nix_copy(cacheurl, paths, refresh=True)
+        return failed + drv_copy.result()
 
-    nixcopy = ["nix", "copy", "--from", cacheurl]
-    if derivation:
-        nixcopy.insert(2, "--derivation")
 
-    nixcopy.extend(paths)
+def check_copied(failed: list[tuple[str, int]]):
+    """Reports failed copies and exits with exit code of the first one
 
-    result = subprocess.run(nixcopy, stdout=subprocess.PIPE, check=False)
-    if result.returncode != 0:
-        perror(result.stderr, result.returncode)
+    @param failed: list of (path, exit code) of failed copies
+    """
+    if failed:
+        lines = [f"Copying {path} failed with code {code}" for path, code in failed]
+        perror("Error: " + "\n".join(lines), failed[0][1])
 
 
 def get_outputs(iout: list[dict] | None) -> list:
@@ -64,6 +196,13 @@ def get_outputs(iout: list[dict] | None) -> list:
     return oout
 
 
+# Image file types, longer suffixes first
+IMAGE_TYPES = (".img.zst", ".img", ".iso", ".raw")
+
+# Depth of directories in outputs searched for images
+IMAGE_DEPTH = 2
+
+
 # Translate table for json items, used by translate function
 transtable = {
     "build": "Build ID",
@@ -132,91 +271,182 @@ def min_info_from_env() -> dict:
     return res
 
 
-def main():
-    """Main function"""
-    cacheurl = "https://cache.vedenemo.dev"
-    wlist = "wlist.txt"
+def load_handoff() -> dict | None:
+    """Load build info passed by hydrascrape -handoff in a JSON file
 
-    # Allow cache url override
-    cacheurl = os.getenv("ACTION_CACHEURL", cacheurl)
+    @return: dictionary of build info, None if not given
+    """
+    filename = os.getenv("HYDRA_BUILDINFO_JSON")
+    if filename is None:
+        return None
 
-    # Allow wlist file name override
-    wlist = os.getenv("ACTION_WLISTFILE", wlist)
+    try:
+        with open(filename, "r", encoding="utf-8") as handoff_file:
+            return json.load(handoff_file)
+    except (OSError, ValueError) as error:
+        perror(f"Error: Cannot read build info from {filename}: {error}")
+    return None
 
-    bnum = os.getenv("HYDRA_BUILD_ID")
-    if bnum is None:
-        perror("Error: HYDRA_BUILD_ID not defined", 0)
 
-    print(f"Hydra Build ID: {bnum}")
+def get_info(hinfo: dict | None, name: str) -> str | None:
+    """Get build info value from handoff build info or environment
 
-    provenance_file = os.getenv("HYDRA_PROVENANCE_FILE")
-    if provenance_file is None:
-        perror("Error: HYDRA_PROVENANCE_FILE not defined", 0)
+    @param hinfo: dictionary of handoff build info or None
+    @param name: name of the value in build info, e.g. "Build ID"
 
-    outputs = []
-    for key, value in os.environ.items():
-        if key.startswith("HYDRA_POSTBUILD_PACKAGE_OUTPUT_PATH_"):
-            index = int(key[-1])
-            signature = os.getenv(f"HYDRA_POSTBUILD_PACKAGE_OUTPUT_SIGNATURE_{index}")
-            if signature is None:
-                # if signing fails with "no slots" error, we can still accept the build
-                # it will get caught in signature verification
-                print("Warning: No output signature")
-                signature = ""
-            outputs.append([value, signature])
+    @return: the value or None if not available
+    """
+    if hinfo is not None:
+        return hinfo.get(name)
+    return os.getenv(f"HYDRA_{name.upper().replace(' ', '_')}")
 
-    if not outputs:
-        perror("Error: Not any POSTBUILD_PACKAGE_OUTPUT defined", 0)
 
-    # Copy provenance file
-    # refresh the narinfo to get up to date cache information
-    nix_copy(cacheurl, [provenance_file], refresh=True)
+def get_postbuild_outputs(hinfo: dict | None) -> list:
+    """Get postbuild package outputs and their signatures
 
-    with open(provenance_file, "r", encoding="utf-8") as pb_file:
-        provenance = json.load(pb_file)
+    @param hinfo: dictionary of handoff build info or None
 
-    # get buildinfo from provenance file
-    binfo = provenance["hydra_buildInfo"]
+    @return: list of [output path, signature] pairs in output index order
+    """
+    if hinfo is not None:
+        prefix = "Postbuild package output path "
+        names = hinfo.keys()
+    else:
+        prefix = "HYDRA_POSTBUILD_PACKAGE_OUTPUT_PATH_"
+        names = os.environ.keys()
 
-    # Check status of the build, we are interested only in finished builds
-    if (
-        binfo.get("buildStatus") != 0
-        or binfo.get("finished") is not True
-        or binfo.get("event") != "buildFinished"
-    ):
-        perror(f"Unexpected build status: {binfo.get('buildStatus')}" ", ignoring", 0)
+    indexes = []
+    for name in names:
+        if name.startswith(prefix):
+            index = name.removeprefix(prefix)
+            if index.isdigit():
+                indexes.append(index)
+
+    outputs = []
+    for index in sorted(indexes, key=int):
+        path = get_info(hinfo, f"Postbuild package output path {index}")
+        signature = get_info(hinfo, f"Postbuild package output signature {index}")
+        if signature is None:
+            # if signing fails with "no slots" error, we can still accept the build
+            # it will get caught in signature verification
+            print("Warning: No output signature")
+            signature = ""
+        outputs.append([path, signature])
+    return outputs
+
+
+def copied_paths(provenance_file: str, outputs: list) -> list[str]:
+    """Get store paths copied for a build, except the derivation
 
-    # Copy output paths
+    @param provenance_file: path of the provenance file
+    @param outputs: list of [output path, signature] pairs
+
+    @return: list of paths
+    """
+    paths = [provenance_file]
     for output in outputs:
-        to_copy = [output[0]]
+        paths.append(output[0])
         # copy signature if it exists
-        if output[1] is not None:
-            to_copy.append(output[1])
+        if output[1]:
+            paths.append(output[1])
+    return paths
 
-        nix_copy(cacheurl, to_copy, refresh=True)
 
-    # Copy derivation
-    drv = binfo.get("drvPath")
-    if drv is not None:
-        nix_copy(cacheurl, [drv], derivation=True, refresh=True)
+def build_finished(binfo: dict) -> bool:
+    """Check status of the build, we are interested only in finished builds
+
+    @param binfo: build info from provenance file
+
+    @return: True if build finished successfully
+    """
+    return (
+        binfo.get("buildStatus") == 0
+        and binfo.get("finished") is True
+        and binfo.get("event") == "buildFinished"
+    )
+
+
+def find_images(outputs: list) -> list[dict]:
+    """Find image files in output directories
+
+    Every directory is scanned once, down to IMAGE_DEPTH levels, e.g.
+    <output>/nixos.img and <output>/sd-image/<name>.img.zst are found.
+
+    @param outputs: list of [output path, signature] pairs
+
+    @return: list of images with path, type, size and output path
+    """
+    images = []
+    for output in outputs:
+        found = []
+        directories = [(output[0], 1)]
+        while directories:
+            directory, depth = directories.pop()
+            try:
+                with os.scandir(directory) as entries:
+                    for entry in entries:
+                        # Symlinks to other store paths are not followed
+                        if entry.is_dir(follow_symlinks=False):
+                            if depth < IMAGE_DEPTH:
+                                directories.append((entry.path, depth + 1))
+                            continue
+                        image_type = next(
+                            (t for t in IMAGE_TYPES if entry.name.endswith(t)), None
+                        )
+                        if image_type is not None and entry.is_file():
+                            found.append(
+                                {
+                                    "path": entry.path,
+                                    "type": image_type[1:],
+                                    "size": entry.stat().st_size,
+                                    "output": output[0],
+                                }
+                            )
+            except (FileNotFoundError, NotADirectoryError):
+                continue
+        images += sorted(found, key=lambda image: image["path"])
+    return images
+
+
+def write_build(
+    hinfo: dict | None,
+    provenance_file: str,
+    outputs: list,
+    provenance: dict,
+    wlist: str,
+):
+    """Write combined build info and add build to post processing list
+
+    @param hinfo: dictionary of handoff build info or None
+    @param provenance_file: path of the provenance file
+    @param outputs: list of [output path, signature] pairs
+    @param provenance: contents of the provenance file
+    @param wlist: name of post processing list file
+    """
+    bnum = get_info(hinfo, "Build ID")
+    binfo = provenance["hydra_buildInfo"]
 
     handling_directory = (
         provenance["predicate"]["buildDefinition"]["internalParameters"]["server"]
         + ".vedenemo.dev"
     )
 
-    try:
-        with open(
-            f"{handling_directory}/{bnum}.json", "r", encoding="utf-8"
-        ) as json_file:
-            combo = json.load(json_file)
-    except FileNotFoundError:
-        # If scraped json is not available, use minimal build info from env
-        combo = min_info_from_env()
+    if hinfo is not None:
+        # Handoff file has all the scraped build info
+        combo = hinfo
+    else:
+        try:
+            with open(
+                f"{handling_directory}/{bnum}.json", "r", encoding="utf-8"
+            ) as json_file:
+                combo = json.load(json_file)
+        except FileNotFoundError:
+            # If scraped json is not available, use minimal build info from env
+            combo = min_info_from_env()
 
     translate(binfo, combo)
 
-    package = os.getenv("HYDRA_POSTBUILD_PACKAGE")
+    package = get_info(hinfo, "Postbuild package")
     combo["Output package"] = package
 
     combo["Outputs"] = [
@@ -229,22 +459,10 @@ def main():
 
     combo["Provenance"] = {
         "path": provenance_file,
-        "signature": os.getenv("HYDRA_PROVENANCE_SIGNATURE"),
+        "signature": get_info(hinfo, "Provenance signature"),
     }
 
-    sd_image = None
-    match = re.search(r"nix/store/[a-z0-9]{32}-(.*)\.img", outputs[0][0])
-    if match is not None:
-        sd_image = outputs[0][0] + "/sd-image/" + match.group(1) + ".img.zst"
-
-    nixos_img = outputs[0][0] + "/nixos.img"
-
-    if sd_image is not None and os.path.exists(sd_image):
-        combo["Image"] = sd_image
-    elif os.path.exists(nixos_img):
-        combo["Image"] = nixos_img
-    else:
-        combo["Image"] = None
+    combo["Images"] = find_images(outputs)
 
     # Write combined info to scraped build info file
     with open(f"{handling_directory}/{bnum}.json", "w", encoding="utf-8") as json_file:
@@ -255,6 +473,225 @@ def main():
         print(f"{bnum}:{' '.join(o[0] for o in outputs)}", file=wlist_file)
 
 
+def handle_build(cacheurl: str, wlist: str):
+    """Handle a single build given by hydrascrape
+
+    @param cacheurl: URL of the binary cache
+    @param wlist: name of post processing list file
+    """
+    # Build info is passed either in a JSON file or in environment variables
+    hinfo = load_handoff()
+
+    bnum = get_info(hinfo, "Build ID")
+    if bnum is None:
+        perror("Error: HYDRA_BUILD_ID not defined", 0)
+
+    print(f"Hydra Build ID: {bnum}")
+
+    provenance_file = get_info(hinfo, "Provenance file")
+    if provenance_file is None:
+        perror("Error: HYDRA_PROVENANCE_FILE not defined", 0)
+
+    outputs = get_postbuild_outputs(hinfo)
+
+    if not outputs:
+        perror("Error: Not any POSTBUILD_PACKAGE_OUTPUT defined", 0)
+
+    # Copy provenance file with outputs and their signatures, and the
+    # derivation if it is known already, refresh the narinfo to get up to
+    # date cache information
+    to_copy = copied_paths(provenance_file, outputs)
+    drv = get_info(hinfo, "Derivation store path")
+    check_copied(nix_copy_all(cacheurl, to_copy, [drv] if drv else []))
+
+    with open(provenance_file, "r", encoding="utf-8") as pb_file:
+        provenance = json.load(pb_file)
+
+    # get buildinfo from provenance file
+    binfo = provenance["hydra_buildInfo"]
+
+    if not build_finished(binfo):
+        perror(f"Unexpected build status: {binfo.get('buildStatus')}" ", ignoring", 0)
+
+    # Copy derivation, unless it was copied already
+    drv = binfo.get("drvPath")
+    if drv is not None:
+        check_copied(nix_copy(cacheurl, [drv], derivation=True, refresh=True))
+
+    write_build(hinfo, provenance_file, outputs, provenance, wlist)
+
+
+def load_builds(filename: str) -> list[dict]:
+    """Load build infos from a JSON list or NDJSON file
+
+    @param filename: name of the file, - for standard input
+
+    @return: list of build info dictionaries
+    """
+    try:
+        if filename == "-":
+            text = sys.stdin.read()
+        else:
+            with open(filename, "r", encoding="utf-8") as builds_file:
+                text = builds_file.read()
+        if text.lstrip().startswith("["):
+            return json.loads(text)
+        return [json.loads(line) for line in text.splitlines() if line.strip()]
+    except (OSError, ValueError) as error:
+        perror(f"Error: Cannot read build info from {filename}: {error}")
+    return []
+
+
+def report_done(results: str | None, bnum):
+    """Add build to results file of handled builds
+
+    Builds are added one by one, so that builds handled before an
+    interruption are not handled again.
+
+    @param results: name of results file or None
+    @param bnum: build ID
+    """
+    if results is not None and bnum is not None:
+        with open(results, "a", encoding="utf-8") as results_file:
+            print(bnum, file=results_file)
+
+
+def handle_builds(filename: str, cacheurl: str, wlist: str, results=None) -> int:
+    """Handle many builds with as few nix copy invocations as possible
+
+    Paths of all the builds are copied together, concurrently with the
+    derivations known from build info, then the rest of the derivations of
+    the finished builds. A build whose paths could not be copied is reported and
+    skipped, other builds are still handled. IDs of the builds which are done
+    with, i.e. handled or ignored like in the single build mode, are written
+    into the results file, so that hydrascrape can retry the failed ones.
+
+    @param filename: name of JSON list or NDJSON file of build infos
+    @param cacheurl: URL of the binary cache
+    @param wlist: name of post processing list file
+    @param results: name of results file or None
+
+    @return: exit code, 1 if any build failed
+    """
+    builds = []
+    for hinfo in load_builds(filename):
+        bnum = hinfo.get("Build ID")
+        provenance_file = hinfo.get("Provenance file")
+        outputs = get_postbuild_outputs(hinfo)
+        if provenance_file is None or not outputs:
+            print(f"Build {bnum}: No postbuild info, ignoring", file=sys.stderr)
+            report_done(results, bnum)
+            continue
+        builds.append((hinfo, provenance_file, outputs))
+
+    print(f"Handling {len(builds)} builds")
+
+    # Copy union of provenance files, outputs and their signatures, and
+    # derivations known from build info
+    paths = {}
+    drvs = {}
+    for hinfo, provenance_file, outputs in builds:
+        paths.update(dict.fromkeys(copied_paths(provenance_file, outputs)))
+        if hinfo.get("Derivation store path"):
+            drvs[hinfo["Derivation store path"]] = None
+    failed = dict(nix_copy_all(cacheurl, list(paths), list(drvs)))
+
+    errors = 0
+    finished = []
+    for hinfo, provenance_file, outputs in builds:
+        bnum = hinfo["Build ID"]
+        failed_paths = [
+            p for p in copied_paths(provenance_file, outputs) if p in failed
+        ]
+        if failed_paths:
+            for path in failed_paths:
+                print(
+                    f"Build {bnum}: Copying {path} failed with code {failed[path]}",
+                    file=sys.stderr,
+                )
+            errors += 1
+            continue
+
+        try:
+            with open(provenance_file, "r", encoding="utf-8") as pb_file:
+                provenance = json.load(pb_file)
+        except (OSError, ValueError) as error:
+            print(f"Build {bnum}: Cannot read provenance: {error}", file=sys.stderr)
+            errors += 1
+            continue
+
+        binfo = provenance["hydra_buildInfo"]
+        if not build_finished(binfo):
+            print(
+                f"Build {bnum}: Unexpected build status: "
+                f"{binfo.get('buildStatus')}, ignoring",
+                file=sys.stderr,
+            )
+            report_done(results, bnum)
+            continue
+        finished.append((hinfo, provenance_file, outputs, provenance))
+
+    # Copy rest of derivations of finished builds, copied ones are skipped
+    drvs = [
+        provenance["hydra_buildInfo"]["drvPath"]
+        for _, _, _, provenance in finished
+        if provenance["hydra_buildInfo"].get("drvPath") is not None
+        and provenance["hydra_buildInfo"]["drvPath"] not in failed
+    ]
+    failed.update(
+        nix_copy(cacheurl, list(dict.fromkeys(drvs)), derivation=True, refresh=True)
+    )
+
+    handled = 0
+    for hinfo, provenance_file, outputs, provenance in finished:
+        drv = provenance["hydra_buildInfo"].get("drvPath")
+        if drv in failed:
+            print(
+                f"Build {hinfo['Build ID']}: Copying {drv} failed "
+                f"with code {failed[drv]}",
+                file=sys.stderr,
+            )
+            errors += 1
+            continue
+        write_build(hinfo, provenance_file, outputs, provenance, wlist)
+        report_done(results, hinfo["Build ID"])
+        handled += 1
+
+    print(f"{handled} builds handled, {errors} failed")
+    return 1 if errors else 0
+
+
+def main():
+    """Main function
+
+    Without arguments, handles the build given by hydrascrape in environment,
+    or the builds given by hydrascrape -batch in HYDRA_BUILDS_NDJSON.
+    With -batch FILE, handles all builds in a JSON list or NDJSON file of
+    build infos. IDs of the builds done with are written into the file named
+    in HYDRA_BUILDS_RESULT, if given.
+    """
+    cacheurl = "https://cache.vedenemo.dev"
+    wlist = "wlist.txt"
+
+    # Allow cache url override
+    cacheurl = os.getenv("ACTION_CACHEURL", cacheurl)
+
+    # Allow wlist file name override
+    wlist = os.getenv("ACTION_WLISTFILE", wlist)
+
+    results = os.getenv("HYDRA_BUILDS_RESULT")
+    if len(sys.argv) == 3 and sys.argv[1] == "-batch":
+        sys.exit(handle_builds(sys.argv[2], cacheurl, wlist, results))
+    if len(sys.argv) != 1:
+        perror(f"Usage: {sys.argv[0]} [-batch <build info file>]")
+
+    builds_file = os.getenv("HYDRA_BUILDS_NDJSON")
+    if builds_file is not None:
+        sys.exit(handle_builds(builds_file, cacheurl, wlist, results))
+
+    handle_build(cacheurl, wlist)
+
+
 # Run main when executed from command line
 if __name__ == "__main__":
     main()
@@ -0,0 +1,594 @@
+#!/usr/bin/env pipenv-shebang
+# ------------------------------------------------------------------------
+# SPDX-FileCopyrightText: 2023 Technology Innovation Institute (TII)
+# SPDX-License-Identifier: Apache-2.0
+# ------------------------------------------------------------------------
+"""
+Offline benchmark for hydrascrape.py
+
+Starts a local fake Hydra server serving synthetic projects, jobsets,
+evaluations and builds both as HTML pages and through the JSON API, runs
+hydrascrape.py against it and reports wall-clock time, number of requests
+and peak RSS of every pass.
+
+Runs after the first one reuse the handled builds file, state and page cache,
+so they show the cost of an incremental scan.
+
+Example, compare HTML and JSON backends with 100 ms latency:
+python3 benchmark.py -latency 0.1 -evals 20
+python3 benchmark.py -latency 0.1 -evals 20 -- -jsonapi
+"""
+
+import argparse
+import gzip
+import hashlib
+import json
+import os
+import shutil
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# Fake store path hashes
+OUT_HASH = "a" * 32
+DRV_HASH = "d" * 32
+PROV_HASH = "p" * 32
+SIG_HASH = "s" * 32
+REVISION = "c" * 40
+
+# Fake timestamp of the first build
+EPOCH = 1700000000
+
+# Evaluations shown on the jobset page, like in Hydra
+JOBSET_EVALS = 10
+
+
+class FakeHydra:
+    """Synthetic Hydra contents
+
+    Every project has the same number of jobsets, every jobset the same
+    number of evaluations and every evaluation the same number of builds.
+    Build IDs divisible by 11 have failed, by 13 are still scheduled and
+    by 7 have a RunCommand which is still running.
+    """
+
+    # pylint: disable=too-many-instance-attributes,too-many-arguments
+    def __init__(
+        self, projects, jobsets, evals, builds, inputs=1, page_size=20, log_lines=0
+    ):
+        self.projects = projects
+        self.jobsets = jobsets
+        self.evals = evals
+        self.builds = builds
+        self.inputs = inputs
+        self.page_size = page_size
+        self.log_lines = log_lines
+        self.requests = 0
+        self.bytes = 0
+        self.lock = threading.Lock()
+
+    def count(self, size):
+        """Count a served request
+
+        @param size: Size of the response body
+        """
+        with self.lock:
+            self.requests += 1
+            self.bytes += size
+
+    def reset(self):
+        """Reset request counters"""
+        with self.lock:
+            self.requests = 0
+            self.bytes = 0
+
+    def eval_id(self, proj, jobset, evaluation):
+        """Get ID of an evaluation
+
+        @param proj: Project index
+        @param jobset: Jobset index
+        @param evaluation: Evaluation index within the jobset
+        @return: Evaluation ID
+        """
+        return 1 + (proj * self.jobsets + jobset) * self.evals + evaluation
+
+    def locate_eval(self, eid):
+        """Get indexes of an evaluation
+
+        @param eid: Evaluation ID
+        @return: Tuple of project, jobset and evaluation indexes
+        """
+        num, evaluation = divmod(eid - 1, self.evals)
+        proj, jobset = divmod(num, self.jobsets)
+        return proj, jobset, evaluation
+
+    def eval_builds(self, eid):
+        """Get IDs of the builds of an evaluation
+
+        @param eid: Evaluation ID
+        @return: List of build IDs
+        """
+        first = 1 + (eid - 1) * self.builds
+        return list(range(first, first + self.builds))
+
+    def locate_build(self, bid):
+        """Get indexes of a build
+
+        @param bid: Build ID
+        @return: Tuple of project, jobset, evaluation and job indexes
+        """
+        eid, job = divmod(bid - 1, self.builds)
+        return self.locate_eval(eid + 1) + (job,)
+
+    def valid(self, proj, jobset=0):
+        """Check that indexes are within limits
+
+        @param proj: Project index
+        @param jobset: Jobset index
+        @return: True if project and jobset exist
+        """
+        return 0 <= proj < self.projects and 0 <= jobset < self.jobsets
+
+    @staticmethod
+    def status(bid):
+        """Get status of a build
+
+        @param bid: Build ID
+        @return: Tuple of status text and Hydra build status, None if unfinished
+        """
+        if bid % 11 == 0:
+            return "Failed", 1
+        if bid % 13 == 0:
+            return "Scheduled to be built", None
+        return "Success", 0
+
+    def eval_json(self, eid):
+        """Get JSON data of an evaluation
+
+        @param eid: Evaluation ID
+        @return: Evaluation data
+        """
+        return {
+            "id": eid,
+            "builds": self.eval_builds(eid),
+            "jobsetevalinputs": {
+                f"input{i}": {
+                    "uri": f"https://example.com/repo{i}",
+                    "revision": REVISION,
+                    "type": "git",
+                }
+                for i in range(self.inputs)
+            },
+        }
+
+    def build_json(self, bid):
+        """Get JSON data of a build
+
+        Like in stock Hydra, there are no sizes, meta attributes or run
+        command logs.
+
+        @param bid: Build ID
+        @return: Build data
+        """
+        proj, jobset, evaluation, job = self.locate_build(bid)
+        _, buildstatus = self.status(bid)
+        return {
+            "id": bid,
+            "finished": 0 if buildstatus is None else 1,
+            "buildstatus": buildstatus,
+            "system": "x86_64-linux",
+            "nixname": f"out-{bid}",
+            "job": f"job{job}",
+            "project": f"project{proj}",
+            "jobset": f"jobset{jobset}",
+            "timestamp": EPOCH + bid,
+            "starttime": EPOCH + 100 + bid,
+            "stoptime": EPOCH + 200 + bid,
+            "drvpath": f"/nix/store/{DRV_HASH}-out-{bid}.drv",
+            "buildoutputs": {"out": {"path": f"/nix/store/{OUT_HASH}-out-{bid}"}},
+            "jobsetevals": [self.eval_id(proj, jobset, evaluation)],
+        }
+
+    def build_html(self, host, bid):
+        """Get build page
+
+        @param host: Host name used in links
+        @param bid: Build ID
+        @return: HTML page
+        """
+        proj, jobset, _, job = self.locate_build(bid)
+        status, _ = self.status(bid)
+        runcommand = ""
+        if status == "Success":
+            if bid % 7 == 0:
+                runcommand = (
+                    '<div class="flex-row">'
+                    '<img class="build-status" title="Running"></div>'
+                )
+            else:
+                runcommand = (
+                    '<div class="flex-row">'
+                    '<img class="build-status" title="Succeeded">'
+                    '<a class="btn btn-secondary btn-sm" '
+                    f'href="http://{host}/runcommandlog/log-{bid}/raw">Raw</a></div>'
+                )
+        inputs = "".join(
+            f"<tr><td>input{i}</td><td>git</td>"
+            f"<td>https://example.com/repo{i}</td><td>{REVISION}</td></tr>"
+            for i in range(self.inputs)
+        )
+        return f"""<html><body>
+<div class="page-header">Build {bid} of job project{proj}:jobset{jobset}:job{job}</div>
+<div id="tabs-summary"><table>
+<tr><th>Build ID:</th><td>{bid}</td></tr>
+<tr><th>Status:</th><td>
+<span class="badge">{status}</span></td></tr>
+<tr><th>System:</th><td><tt>x86_64-linux</tt></td></tr>
+<tr><th>Nix name:</th><td><tt>out-{bid}</tt></td></tr>
+</table>
+{runcommand}
+</div>
+<div id="tabs-details"><table>
+<tr><th>Queued at:</th><td><time data-timestamp="{EPOCH + bid}">q</time></td></tr>
+<tr><th>Build started:</th><td><time data-timestamp="{EPOCH + 100 + bid}">s</time></td></tr>
+<tr><th>Build finished:</th><td><time data-timestamp="{EPOCH + 200 + bid}">f</time></td></tr>
+<tr><th>Short description:</th><td>not given</td></tr>
+<tr><th>Derivation store path:</th><td><tt>/nix/store/{DRV_HASH}-out-{bid}.drv</tt></td></tr>
+<tr><th>Output store paths:</th><td><tt>/nix/store/{OUT_HASH}-out-{bid}</tt></td></tr>
+<tr><th>Closure size:</th><td>12.00 MiB</td></tr>
+</table></div>
+<div id="tabs-buildinputs"><table><tbody>
+{inputs}
+</tbody></table></div>
+</body></html>"""
+
+    def runcommand_log(self, bid):
+        """Get RunCommand log of a build, as printed by the post build hooks
+
+        Upload output is simulated by log_lines lines before and message
+        script output by log_lines lines after the variables.
+
+        @param bid: Build ID
+        @return: Log text
+        """
+        upload = "".join(
+            f"copying path '/nix/store/{OUT_HASH}-dep-{i}' to 'https://cache'...\n"
+            for i in range(self.log_lines)
+        )
+        message = "".join(
+            f'{{"text": "Build {bid} finished", "line": {i}}}\n'
+            for i in range(self.log_lines)
+        )
+        return (
+            f"Running post build actions for build {bid}\n{upload}"
+            f'PROVENANCE_FILE="/nix/store/{PROV_HASH}-provenance-{bid}.json"\n'
+            f'PROVENANCE_SIGNATURE="/nix/store/{SIG_HASH}-provenance-{bid}.sig"\n'
+            f'POSTBUILD_PACKAGE_OUTPUT_PATH_0="/nix/store/{OUT_HASH}-out-{bid}"\n'
+            f'POSTBUILD_PACKAGE_OUTPUT_SIGNATURE_0="/nix/store/{SIG_HASH}-out-{bid}.sig"\n'
+            f'POSTBUILD_PACKAGE="job/out-{bid}.tar.xz"\n{message}'
+        )
+
+    def table(self, host, path, names, row_class=""):
+        """Get a page with a table of links
+
+        @param host: Host name used in links
+        @param path: Path prefix of the links
+        @param names: Link targets
+        @param row_class: Class of the table rows
+        @return: HTML page
+        """
+        rows = "".join(
+            f'<tr class="{row_class}"><td><a class="row-link" href="http://{host}/{path}{name}">'
+            f"{name}</a></td></tr>"
+            for name in names
+        )
+        return f"<html><body><table><tbody>{rows}</tbody></table></body></html>"
+
+    def page(self, host, path, query, use_json):
+        """Get contents of a page
+
+        @param host: Host name used in links
+        @param path: List of path components
+        @param query: Parsed query parameters
+        @param use_json: Return JSON API data instead of HTML
+        @return: Tuple of content type and body, None if page does not exist
+        """
+        # pylint: disable=too-many-return-statements
+        if not path:
+            if use_json:
+                return [
+                    {"name": f"project{p}", "enabled": 1, "hidden": 0}
+                    for p in range(self.projects)
+                ]
+            return self.table(
+                host,
+                "project/",
+                (f"project{p}" for p in range(self.projects)),
+                "project",
+            )
+
+        kind, args = path[0], path[1:]
+        if kind == "project" and len(args) == 1:
+            proj = int(args[0].removeprefix("project"))
+            if not self.valid(proj):
+                return None
+            names = [f"jobset{j}" for j in range(self.jobsets)]
+            if use_json:
+                return {"name": args[0], "enabled": 1, "hidden": 0, "jobsets": names}
+            return self.table(host, f"jobset/{args[0]}/", names, "jobset")
+
+        if kind == "jobset" and len(args) in (2, 3):
+            proj = int(args[0].removeprefix("project"))
+            jobset = int(args[1].removeprefix("jobset"))
+            if not self.valid(proj, jobset):
+                return None
+            if len(args) == 2 and use_json:
+                return {"name": args[1], "project": args[0], "enabled": 1, "hidden": 0}
+            if len(args) == 3 and args[2] != "evals":
+                return None
+            # Newest evaluations first, like in Hydra
+            evals = [self.eval_id(proj, jobset, e) for e in reversed(range(self.evals))]
+            page = int(query.get("page", "1"))
+            if len(args) == 2:
+                # Jobset page shows fewer evaluations than evaluations pages
+                shown = evals[:JOBSET_EVALS]
+            else:
+                shown = evals[(page - 1) * self.page_size : page * self.page_size]
+            if not use_json:
+                return self.table(host, "eval/", shown)
+            more = page * self.page_size < len(evals)
+            return {
+                "evals": [self.eval_json(eid) for eid in shown],
+                "next": f"?page={page + 1}" if more else None,
+            }
+
+        if kind == "eval" and len(args) == 1:
+            eid = int(args[0])
+            if not 0 < eid <= self.projects * self.jobsets * self.evals:
+                return None
+            if use_json:
+                return self.eval_json(eid)
+            return self.table(host, "build/", reversed(self.eval_builds(eid)))
+
+        if kind == "build" and len(args) == 1:
+            bid = int(args[0])
+            if not 0 < bid <= self.projects * self.jobsets * self.evals * self.builds:
+                return None
+            if use_json:
+                return self.build_json(bid)
+            return self.build_html(host, bid)
+
+        if kind == "runcommandlog" and args:
+            return self.runcommand_log(int(args[0].removeprefix("log-")))
+
+        return None
+
+
+class FakeHydraHandler(BaseHTTPRequestHandler):
+    """Request handler serving pages of the server's FakeHydra instance"""
+
+    protocol_version = "HTTP/1.1"
+    disable_nagle_algorithm = True
+
+    def log_message(self, *_):  # pylint: disable=arguments-differ
+        pass
+
+    def send(self, code, content_type, body):
+        """Send a response, compressed and with an ETag
+
+        @param code: HTTP status code
+        @param content_type: Content type of the body
+        @param body: Response body
+        """
+        body = body.encode()
+        etag = f'"{hashlib.sha1(body).hexdigest()}"'
+        compressed = False
+        if code == 200 and self.headers.get("If-None-Match") == etag:
+            code, body = 304, b""
+        elif "gzip" in self.headers.get("Accept-Encoding", ""):
+            body = gzip.compress(body)
+            compressed = True
+
+        self.server.hydra.count(len(body))
+        self.send_response(code)
+        if code != 304:
+            self.send_header("Content-Type", content_type)
+        if compressed:
+            self.send_header("Content-Encoding", "gzip")
+        self.send_header("ETag", etag)
+        self.send_header("Content-Length", str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def do_GET(self):  # pylint: disable=invalid-name
+        """Serve a page"""
+        if self.server.latency:
+            time.sleep(self.server.latency)
+
+        path, _, query = self.path.partition("?")
+        query = dict(arg.partition("=")[::2] for arg in query.split("&") if arg)
+        use_json = "application/json" in self.headers.get("Accept", "")
+        try:
+            content = self.server.hydra.page(
+                self.headers.get("Host"),
+                [part for part in path.split("/") if part],
+                query,
+                use_json,
+            )
+        except ValueError:
+            content = None
+
+        if content is None:
+            self.send(404, "text/plain", "Not found")
+        elif isinstance(content, str):
+            self.send(
+                200,
+                "text/plain" if path.startswith("/runcommandlog/") else "text/html",
+                content,
+            )
+        else:
+            self.send(200, "application/json", json.dumps(content))
+
+
+class FakeHydraServer(ThreadingHTTPServer):
+    """HTTP server for the fake Hydra"""
+
+    daemon_threads = True
+
+    def __init__(self, address, hydra, latency):
+        """Initialize server
+
+        @param address: Tuple of address and port to listen to
+        @param hydra: FakeHydra instance to serve
+        @param latency: Delay in seconds before every response
+        """
+        super().__init__(address, FakeHydraHandler)
+        self.hydra = hydra
+        self.latency = latency
+
+    def handle_error(self, request, client_address):
+        # Clients may close connections without reading whole responses
+        if not isinstance(sys.exc_info()[1], ConnectionError):
+            super().handle_error(request, client_address)
+
+
+def start_server(hydra, latency):
+    """Start fake Hydra server on a free local port in a background thread
+
+    @param hydra: FakeHydra instance to serve
+    @param latency: Delay in seconds before every response
+    @return: Server instance
+    """
+    server = FakeHydraServer(("127.0.0.1", 0), hydra, latency)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server
+
+
+def run_pass(command, workdir):
+    """Run a hydrascrape pass and measure it
+
+    @param command: Command line to run
+    @param workdir: Working directory
+    @return: Tuple of exit code, wall-clock seconds, CPU seconds and peak RSS
+             in kilobytes
+    """
+    start = time.monotonic()
+    with subprocess.Popen(command, cwd=workdir) as proc:
+        # wait4 gives resource usage of this process and its waited children only
+        _, status, rusage = os.wait4(proc.pid, 0)
+        proc.returncode = os.waitstatus_to_exitcode(status)
+    cpu = rusage.ru_utime + rusage.ru_stime
+    return proc.returncode, time.monotonic() - start, cpu, rusage.ru_maxrss
+
+
+def main(argv):
+    """Main function
+
+    @param argv: Command line parameters
+    """
+    parser = argparse.ArgumentParser(
+        description="Benchmark hydrascrape.py against a local fake Hydra server",
+        epilog="Arguments after -- are passed to hydrascrape.py, "
+        "e.g. -- -jsonapi -jobs 8",
+    )
+    parser.add_argument("-projects", type=int, default=2, help="Number of projects")
+    parser.add_argument("-jobsets", type=int, default=3, help="Jobsets per project")
+    parser.add_argument("-evals", type=int, default=5, help="Evaluations per jobset")
+    parser.add_argument("-builds", type=int, default=10, help="Builds per evaluation")
+    parser.add_argument("-inputs", type=int, default=1, help="Inputs per build")
+    parser.add_argument(
+        "-loglines", type=int, default=0, help="Extra lines in RunCommand logs"
+    )
+    parser.add_argument(
+        "-pagesize", type=int, default=20, help="Evaluations per evaluations page"
+    )
+    parser.add_argument(
+        "-latency", type=float, default=0.0, help="Delay of every response in seconds"
+    )
+    parser.add_argument("-runs", type=int, default=2, help="Number of passes")
+    parser.add_argument(
+        "-action", default="true", help="Action run for every build (default true)"
+    )
+    parser.add_argument(
+        "-workdir", help="Keep handled builds and cache in this directory"
+    )
+    parser.add_argument("-out", help="Write results to this file in JSON format")
+    options = []
+    if "--" in argv:
+        options = argv[argv.index("--") + 1 :]
+        argv = argv[: argv.index("--")]
+    args = parser.parse_args(argv)
+
+    hydra = FakeHydra(
+        args.projects,
+        args.jobsets,
+        args.evals,
+        args.builds,
+        args.inputs,
+        args.pagesize,
+        args.loglines,
+    )
+    server = start_server(hydra, args.latency)
+    host = f"127.0.0.1:{server.server_address[1]}"
+
+    workdir = args.workdir or tempfile.mkdtemp(prefix="hydrascrape-benchmark-")
+    os.makedirs(workdir, exist_ok=True)
+    command = [
+        sys.executable,
+        os.path.join(os.path.dirname(os.path.abspath(__file__)), "hydrascrape.py"),
+        host,
+        ".*",
+        ".*",
+        "handled_builds",
+        args.action,
+        "-http",
+        *options,
+    ]
+
+    total = args.projects * args.jobsets * args.evals * args.builds
+    print(f"{total} builds, options: {' '.join(options) or '-'}")
+    print(
+        f"{'run':>4} {'seconds':>9} {'cpu':>9} {'requests':>9} {'kbytes':>9} "
+        f"{'rss MB':>7}"
+    )
+
+    results = []
+    try:
+        for run in range(1, args.runs + 1):
+            hydra.reset()
+            code, seconds, cpu, rss = run_pass(command, workdir)
+            if code != 0:
+                print(f"hydrascrape.py failed with exit code {code}", file=sys.stderr)
+                sys.exit(1)
+            results.append(
+                {
+                    "run": run,
+                    "seconds": round(seconds, 3),
+                    "cpu_seconds": round(cpu, 3),
+                    "requests": hydra.requests,
+                    "bytes": hydra.bytes,
+                    "max_rss_kb": rss,
+                }
+            )
+            print(
+                f"{run:>4} {seconds:>9.3f} {cpu:>9.3f} {hydra.requests:>9} "
+                f"{hydra.bytes // 1024:>9} {rss / 1024:>7.1f}"
+            )
+    finally:
+        server.shutdown()
+        if args.workdir is None:
+            shutil.rmtree(workdir, ignore_errors=True)
+
+    if args.out:
+        with open(args.out, "w", encoding="utf-8") as out:
+            json.dump(
+                {"builds": total, "options": options, "runs": results}, out, indent=4
+            )
+
+
+# Run main when executed from command line
+if __name__ == "__main__":
+    main(sys.argv[1:])
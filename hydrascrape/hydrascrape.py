@@ -8,14 +8,30 @@ Script for extracting build information from a hydra server to
 facilitate further processing in e.g. Jenkins environment.
 """
 
+import base64
+import codecs
+import contextlib
+import email.utils
+import functools
 import gzip
+import hashlib
+import html.parser
+import http.client
 import json
 import os
+import random
 import re
+import signal
 import subprocess
 import sys
+import tempfile
+import threading
+import time
+import urllib.parse
 import urllib.request
-from urllib.error import HTTPError
+import zlib
+from concurrent.futures import ThreadPoolExecutor
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
 
 import bs4
 import filelock
@@ -23,6 +39,17 @@ import filelock
 # Global debug flag
 DEBUG = 0
 
+# Size of chunks in which pages are read line by line
+LINE_CHUNK_SIZE = 64 * 1024
+
+# Variables printed last by the provenance and packaging scripts of the
+# postbuild hook, run command log is not read further after seeing them
+POSTBUILD_LAST_VARS = {"PROVENANCE_FILE", "PROVENANCE_SIGNATURE", "POSTBUILD_PACKAGE"}
+
+# Handled builds file is compacted when it has this many duplicate, unsorted
+# or invalid lines
+COMPACT_LIMIT = 1000
+
 
 def convert_int(input_str, default=0):
     """Convert string to an int with default value if invalid string given
@@ -48,68 +75,1107 @@ def send_help():
     print(
         """
 Usage: python3 hydrascrape.py <server> <project regexp> <jobset regexp> <handled builds file> <action> [options]
+       python3 hydrascrape.py -config <config file> [options]
 
 Tries to find builds to handle for specific projects and jobsets from a hydra server
 Already handled builds will be read from handled builds file if it exists
+Evaluations seen so far are tracked per jobset in <handled builds file>.state
 Successfully handled builds (action returned 0) will be added to the handled builds file
-action will be run with all the build information in the environment
+action will be run with all the build information in the environment, or in a JSON file with -handoff
 
 For example, check environment variables starting with \"HYDRA_\":
 python3 hydrascrape.py my.hydra.server myproject 'job.*' '.*' myhydra_handled_builds.txt 'env | egrep ^HYDRA_' -debug
 
+With -config, several servers are scanned concurrently using targets from a JSON config file:
+{"targets": [{"server": "my.hydra.server", "projects": "myproject", "jobsets": ".*",
+              "handled": "myhydra_handled_builds.txt", "action": "./action.py", "options": ["-json"]}]}
+Each target needs its own handled builds file. Options of a target override the command line options,
+but -parallel, -maxrequests, -retries and -trigger given on the command line are shared by all targets.
+
 Available options:
   -debug  Enable debugging (You can also set DEBUG environment variable to 1)
-  -json   Enable JSON output, build info will be written in JSON format to <build ID>.json before running action
+  -json   Enable JSON output, build info will be written in JSON format to <server>/<build ID>.json before running action
+  -compact        Write JSON files without indentation
+  -handoff        Pass build info to action as a JSON file named in HYDRA_BUILDINFO_JSON
+                  instead of a HYDRA_ environment variable per field and input
+  -batch          Run action once per scan with info of all builds to handle in an NDJSON file
+                  named in HYDRA_BUILDS_NDJSON. The action writes IDs of the builds it is done
+                  with into the file named in HYDRA_BUILDS_RESULT, only those are marked handled
+  -ndjson FILE    Write info of builds handled in a scan to FILE, one JSON object per line
   -dp     Include disabled projects in search
   -hp     Include hidden projects in search
   -dj     Include disabled jobsets in search
   -hj     Include hidden jobsets in search
+  -html   Parse HTML pages (default)
+  -jsonapi        Use Hydra's JSON API instead of HTML pages, only the run command status is read
+                  from the start of the build page. Build JSON of stock Hydra has no closure or
+                  output size, description, license, homepage or maintainers, so they are missing
+  -http   Connect using plain HTTP instead of HTTPS, e.g. to a local test server
+  -jobs N Fetch up to N pages concurrently (default 4)
+  -maxrequests N  Limit number of concurrent HTTP requests to N in total
+  -retries N      Retry failed requests N times with increasing delays (default 3)
+                  If a page still cannot be fetched, the scan fails and the rest is handled on the next run
+  -parser NAME    HTML parser: html.parser (default), lxml (if installed) or
+                  stream, which extracts build information in a single pass
+  -cache DIR      Cache fetched pages in DIR, finished builds are never fetched again
+  -cachesize MB   Maximum size of the page cache (default 1024)
+  -cacheage DAYS  Maximum age of cached pages which may still change (default 7)
+  -parallel N     Run up to N actions concurrently (default 1)
+  -timeout SECS   Kill actions running longer than SECS seconds, build is retried on next run
+  -projectlimit N Run at most N concurrent actions per project
+  -prio REGEX=N   Handle builds whose project:jobset:job contains REGEX with priority N,
+                  highest priority of matching patterns is used (default 0), can be given
+                  several times. Builds with the same priority are handled in queuing order
+  -plan           Only print JSON of builds which would be handled, skipped or marked handled
+                  and of pages fetched, without running actions or writing any files but the cache
+  -daemon         Keep running and scan repeatedly, state is kept in memory between scans
+  -interval SECS  Minimum interval between scans in daemon mode (default 30)
+                  Used while there are unfinished builds, doubled on every scan with no changes
+  -maxinterval SECS  Maximum interval between scans in daemon mode (default 600)
+  -trigger PORT   Trigger a scan at once with a GET or POST to http://127.0.0.1:PORT/scan
+  -evalpages N    Walk back at most N pages of evaluations of a jobset to find the ones
+                  newer than the last known evaluation (default 10)
+  -discoveryttl SECS  Reuse found projects and jobsets for SECS seconds (default 300, 0 disables)
+  -metrics FILE   Write timing statistics of each scan to FILE as JSON,
+                  or in Prometheus text format if FILE ends with .prom
     """
     )
     sys.exit(0)
 
 
-def get_page(context, url):
+class FetchError(Exception):
+    """Raised when a page cannot be fetched even after retrying"""
+
+
+class HttpClient:
+    """Keep-alive HTTP client which keeps a pool of open connections per host
+
+    Connections are taken from the pool for a single request at a time,
+    so the client can be shared between fetching threads.
+
+    Proxies are used like urllib does, as given in http_proxy, https_proxy
+    and no_proxy environment variables. HTTPS connections are tunnelled
+    through the proxy with CONNECT.
+
+    Failed connections, timeouts and responses telling that the server is
+    overloaded or temporarily unavailable are retried with exponential
+    backoff. After too many failures in a row the circuit breaker of the
+    host opens and requests to it fail at once for a while.
+    """
+
+    # How many times redirects are followed
+    max_redirects = 5
+    # Response statuses which are retried
+    retry_statuses = (429, 500, 502, 503, 504)
+    # Delay before the first retry in seconds, doubled on every retry
+    backoff = 1.0
+    # Maximum delay between retries in seconds, also for Retry-After
+    max_delay = 60
+    # Number of failures in a row opening the circuit breaker of a host
+    breaker_limit = 5
+    # Seconds until requests to a host are tried again after breaker opened
+    breaker_time = 60
+
+    def __init__(self, timeout=60, max_requests=None, retries=3):
+        """Initialize an empty connection pool
+
+        @param timeout: Socket timeout in seconds
+        @param max_requests: Maximum number of concurrent requests, None for
+                             no limit
+        @param retries: Number of times a failed request is retried
+        """
+        self.timeout = timeout
+        self.retries = retries
+        self.slots = None
+        if max_requests is not None:
+            self.slots = threading.BoundedSemaphore(max_requests)
+        self.proxies = urllib.request.getproxies()
+        self.lock = threading.Lock()
+        self.idle = {}
+        self.opened = 0
+        self.reused = 0
+        self.retried = 0
+        # Failures in a row and time when breaker opened per host
+        self.failures = {}
+
+    def _proxy(self, scheme, host):
+        """Gets the proxy to use for a host
+
+        @param scheme: URL scheme, http or https
+        @param host: Host and optional port
+
+        @return: tuple of proxy URL parts and headers for the proxy, or None
+                 when connecting directly
+        """
+        proxy = self.proxies.get(scheme)
+        if not proxy or urllib.request.proxy_bypass(host):
+            return None
+        if "://" not in proxy:
+            proxy = f"http://{proxy}"
+        parts = urllib.parse.urlsplit(proxy)
+        headers = {}
+        if parts.username is not None:
+            user = urllib.parse.unquote(parts.username)
+            password = urllib.parse.unquote(parts.password or "")
+            creds = base64.b64encode(f"{user}:{password}".encode("utf-8"))
+            headers["Proxy-Authorization"] = f"Basic {creds.decode('ascii')}"
+        return parts, headers
+
+    def _connection(self, scheme, host):
+        """Gets an idle connection from the pool or opens a new one
+
+        @param scheme: URL scheme, http or https
+        @param host: Host and optional port
+
+        @return: tuple of connection and flag telling if it was reused
+        """
+        with self.lock:
+            idle = self.idle.get((scheme, host))
+            if idle:
+                self.reused += 1
+                return idle.pop(), True
+            self.opened += 1
+
+        proxy = self._proxy(scheme, host)
+        if proxy is None:
+            if scheme == "https":
+                return http.client.HTTPSConnection(host, timeout=self.timeout), False
+            return http.client.HTTPConnection(host, timeout=self.timeout), False
+
+        parts, headers = proxy
+        if scheme == "https":
+            conn = http.client.HTTPSConnection(
+                parts.hostname, parts.port, timeout=self.timeout
+            )
+            conn.set_tunnel(host, headers=headers)
+            return conn, False
+        conn = http.client.HTTPConnection(
+            parts.hostname, parts.port, timeout=self.timeout
+        )
+        return conn, False
+
+    def _release(self, scheme, host, conn):
+        """Returns a connection back to the pool
+
+        @param scheme: URL scheme, http or https
+        @param host: Host and optional port
+        @param conn: Connection to return
+        """
+        with self.lock:
+            self.idle.setdefault((scheme, host), []).append(conn)
+
+    def _open(self, scheme, host, path, headers):
+        """Sends a single GET request without reading the response body,
+        retrying once if a reused connection had been closed by the server
+        while it was idle
+
+        @return: tuple of connection and response
+        """
+        conn, reused = self._connection(scheme, host)
+        # Plain HTTP proxies are given the whole URL instead of a tunnel
+        target, request_headers = path, headers
+        proxy = self._proxy(scheme, host) if scheme == "http" else None
+        if proxy is not None:
+            target = f"http://{host}{path}"
+            request_headers = dict(headers, **proxy[1])
+        try:
+            conn.request("GET", target, headers=request_headers)
+            return conn, conn.getresponse()
+        except (http.client.HTTPException, ConnectionError):
+            conn.close()
+            if not reused:
+                raise
+            # Stale keep-alive connection, try again with a fresh one
+            with self.lock:
+                self.reused -= 1
+            return self._open(scheme, host, path, headers)
+
+    def _finish(self, scheme, host, conn, response):
+        """Returns a connection back to the pool if the whole response was
+        read and the server keeps the connection open, otherwise closes it"""
+        if response.will_close or not response.isclosed():
+            conn.close()
+        else:
+            self._release(scheme, host, conn)
+
+    def _check_breaker(self, host):
+        """Raises FetchError if the circuit breaker of a host is open
+
+        @param host: Host and optional port
+        """
+        with self.lock:
+            _, opened = self.failures.get(host, (0, None))
+        if opened is not None and time.monotonic() - opened < self.breaker_time:
+            raise FetchError(f"{host} is not responding, not trying again yet")
+
+    def _record(self, host, success):
+        """Records result of a request for the circuit breaker of a host
+
+        @param host: Host and optional port
+        @param success: True if request succeeded
+        """
+        with self.lock:
+            if success:
+                self.failures.pop(host, None)
+                return
+            failures = self.failures.get(host, (0, None))[0] + 1
+            opened = time.monotonic() if failures >= self.breaker_limit else None
+            self.failures[host] = (failures, opened)
+
+    def _delay(self, attempt, response):
+        """Gets delay before retrying a request
+
+        @param attempt: Number of the failed attempt, starting from 0
+        @param response: Failed response or None if there was no response
+
+        @return: delay in seconds
+        """
+        # Full jitter spreads the retries of concurrent requests
+        delay = random.uniform(0, min(self.max_delay, self.backoff * 2**attempt))
+        retry_after = response.getheader("Retry-After") if response else None
+        if retry_after is None:
+            return delay
+        if retry_after.strip().isdigit():
+            wait = int(retry_after)
+        else:
+            try:
+                wait = email.utils.parsedate_to_datetime(retry_after).timestamp()
+                wait -= time.time()
+            except (TypeError, ValueError):
+                return delay
+        return max(delay, min(wait, self.max_delay))
+
+    def _follow(self, url, headers):
+        """Sends a GET request following redirects without reading the body
+        of the final response
+
+        @param url: URL to fetch
+        @param headers: Dictionary of request headers
+
+        @return: tuple of URL parts, connection and response
+        """
+        for _ in range(self.max_redirects + 1):
+            parts = urllib.parse.urlsplit(url)
+            path = parts.path or "/"
+            if parts.query:
+                path += f"?{parts.query}"
+
+            conn, response = self._open(parts.scheme, parts.netloc, path, headers)
+            location = response.getheader("Location")
+            if response.status not in (301, 302, 303, 307, 308) or location is None:
+                break
+            response.read()
+            self._finish(parts.scheme, parts.netloc, conn, response)
+            url = urllib.parse.urljoin(url, location)
+
+        return parts, conn, response
+
+    @contextlib.contextmanager
+    def stream(self, url, headers):
+        """Context manager opening given URL following redirects, the response
+        body is left for the caller to read
+
+        If the body is not read completely, the connection is closed instead
+        of returning it to the pool.
+
+        @param url: URL to fetch
+        @param headers: Dictionary of request headers
+
+        @return: response
+        @raise FetchError: if the request failed after retrying or the circuit
+                           breaker of the host is open
+        """
+        host = urllib.parse.urlsplit(url).netloc
+        for attempt in range(self.retries + 1):
+            self._check_breaker(host)
+            response = None
+            # Request slot is held until the response has been read
+            with self.slots or contextlib.nullcontext():
+                try:
+                    parts, conn, response = self._follow(url, headers)
+                except (OSError, http.client.HTTPException) as error:
+                    failure = str(error) or type(error).__name__
+                else:
+                    if response.status not in self.retry_statuses:
+                        self._record(host, True)
+                        try:
+                            yield response
+                        finally:
+                            self._finish(parts.scheme, parts.netloc, conn, response)
+                        return
+
+                    failure = f"HTTP error: {response.status} {response.reason}"
+                    conn.close()
+
+            self._record(host, False)
+            if attempt == self.retries:
+                break
+            delay = self._delay(attempt, response)
+            with self.lock:
+                self.retried += 1
+            if DEBUG:
+                print(f"{failure}, retrying {url} in {delay:.1f} seconds")
+            time.sleep(delay)
+
+        raise FetchError(f"{url}: {failure}")
+
+    def get(self, url, headers):
+        """Fetches given URL following redirects
+
+        @param url: URL to fetch
+        @param headers: Dictionary of request headers
+
+        @return: tuple of response and (still encoded) response body
+        @raise FetchError: if the request failed
+        """
+        with self.stream(url, headers) as response:
+            try:
+                return response, response.read()
+            except (OSError, http.client.HTTPException) as error:
+                raise FetchError(f"{url}: {error}") from error
+
+    def close(self):
+        """Closes all idle connections"""
+        with self.lock:
+            for conns in self.idle.values():
+                for conn in conns:
+                    conn.close()
+            self.idle = {}
+
+
+class PageCache:
+    """On-disk cache of fetched pages
+
+    Entries are files named by a hash of the URL and the accepted content
+    type. Each file has a line of JSON metadata followed by the page data.
+    Immutable entries are used without asking the server, others are
+    revalidated with conditional requests when the server gave an ETag or
+    a Last-Modified header.
+    """
+
+    # Temporary files older than this many seconds are leftovers of
+    # interrupted runs, newer ones may still be written by other threads
+    tmp_age = 3600
+
+    def __init__(self, directory, max_size, max_age):
+        """Initialize cache
+
+        @param directory: Cache directory
+        @param max_size: Maximum total size of the cache in bytes
+        @param max_age: Maximum age of mutable entries in seconds
+        """
+        self.directory = directory
+        self.max_size = max_size
+        self.max_age = max_age
+        self.lock = threading.Lock()
+        self.hits = 0
+        self.revalidated = 0
+        os.makedirs(directory, exist_ok=True)
+
+    def _filename(self, url, headers):
+        """Gets cache file name for given URL and request headers"""
+        key = f"{headers.get('Accept', '')} {url}".encode("utf-8")
+        digest = hashlib.sha256(key).hexdigest()
+        return os.path.join(self.directory, digest[:2], digest)
+
+    def count(self, counter):
+        """Increments given statistics counter"""
+        with self.lock:
+            setattr(self, counter, getattr(self, counter) + 1)
+
+    def get(self, url, headers):
+        """Gets a cached entry
+
+        @param url: URL of the page
+        @param headers: Request headers
+
+        @return: tuple of metadata and page data or None if not cached
+        """
+        filename = self._filename(url, headers)
+        try:
+            with open(filename, "rb") as cache_file:
+                meta = json.loads(cache_file.readline())
+                data = cache_file.read()
+            # Access time is used for evicting least recently used entries
+            os.utime(filename)
+        except (FileNotFoundError, ValueError):
+            return None
+
+        if meta.get("url") != url:
+            return None
+        return meta, data
+
+    def put(self, url, headers, data, meta):
+        """Stores an entry in the cache
+
+        @param url: URL of the page
+        @param headers: Request headers
+        @param data: Page data
+        @param meta: Metadata dictionary with etag, modified and immutable keys
+        """
+        filename = self._filename(url, headers)
+        meta = dict(meta, url=url, stored=time.time())
+        os.makedirs(os.path.dirname(filename), exist_ok=True)
+        tmpname = f"{filename}.{threading.get_ident()}.tmp"
+        with open(tmpname, "wb") as cache_file:
+            cache_file.write(json.dumps(meta).encode("utf-8") + b"\n")
+            cache_file.write(data)
+        os.replace(tmpname, filename)
+
+    def pin(self, url, headers):
+        """Marks an entry immutable so it will be used without revalidation
+
+        @param url: URL of the page
+        @param headers: Request headers
+        """
+        entry = self.get(url, headers)
+        if entry is not None and not entry[0]["immutable"]:
+            self.put(url, headers, entry[1], dict(entry[0], immutable=True))
+
+    def evict(self):
+        """Removes expired mutable entries and least recently used entries
+        until the cache fits in maximum size"""
+        now = time.time()
+        entries = []
+        total = 0
+        for dirpath, _, filenames in os.walk(self.directory):
+            for name in filenames:
+                filename = os.path.join(dirpath, name)
+                if name.endswith(".tmp"):
+                    try:
+                        if now - os.stat(filename).st_mtime > self.tmp_age:
+                            os.remove(filename)
+                    except FileNotFoundError:
+                        pass
+                    continue
+
+                try:
+                    stat = os.stat(filename)
+                    with open(filename, "rb") as cache_file:
+                        meta = json.loads(cache_file.readline())
+                    immutable = meta["immutable"]
+                    # Modification time is updated also when the entry is read
+                    stored = meta["stored"]
+                except (OSError, ValueError, KeyError):
+                    # Broken file
+                    immutable = False
+                    stat = None
+
+                if stat is None or (not immutable and now - stored > self.max_age):
+                    try:
+                        os.remove(filename)
+                    except FileNotFoundError:
+                        pass
+                    continue
+
+                total += stat.st_size
+                entries.append((immutable, stat.st_atime, stat.st_size, filename))
+
+        # Mutable entries go first, then the least recently used ones
+        entries.sort()
+        for _, _, size, filename in entries:
+            if total <= self.max_size:
+                break
+            try:
+                os.remove(filename)
+            except FileNotFoundError:
+                pass
+            total -= size
+
+        if DEBUG:
+            print(f"Page cache: {len(entries)} entries, {total} bytes")
+
+
+class Metrics:
+    """Timing and counter statistics of a scan
+
+    Phase timers can be nested, time spent in a nested phase is not included
+    in the time of the enclosing phase of the same thread. So for example
+    parsing time of a build page does not include the time of fetching it.
+    """
+
+    def __init__(self):
+        """Initialize empty statistics"""
+        self.lock = threading.Lock()
+        self.local = threading.local()
+        self.started = time.monotonic()
+        self.counters = {}
+        self.phases = {}
+
+    def add(self, counter, value=1):
+        """Adds given value to a counter
+
+        @param counter: Name of the counter
+        @param value: Value to add
+        """
+        with self.lock:
+            self.counters[counter] = self.counters.get(counter, 0) + value
+
+    @contextlib.contextmanager
+    def timer(self, phase):
+        """Context manager timing a phase
+
+        @param phase: Name of the phase
+        """
+        stack = self.local.__dict__.setdefault("stack", [])
+        # Time spent in nested phases is collected into the list
+        stack.append([0.0])
+        start = time.monotonic()
+        try:
+            yield
+        finally:
+            elapsed = time.monotonic() - start
+            nested = stack.pop()[0]
+            if stack:
+                stack[-1][0] += elapsed
+            with self.lock:
+                self.phases.setdefault(phase, []).append(elapsed - nested)
+
+    def report(self):
+        """Creates a report of the statistics
+
+        @return: dictionary of counters and phase statistics
+        """
+        phases = {}
+        with self.lock:
+            for phase, times in self.phases.items():
+                times = sorted(times)
+                phases[phase] = {
+                    "count": len(times),
+                    "total": sum(times),
+                    "p50": times[int(0.50 * (len(times) - 1))],
+                    "p95": times[int(0.95 * (len(times) - 1))],
+                    "max": times[-1],
+                }
+            return {
+                "wall_time": time.monotonic() - self.started,
+                "counters": dict(self.counters),
+                "phases": phases,
+            }
+
+    def write(self, filename):
+        """Writes statistics atomically into a file, in Prometheus text format
+        if file name ends with .prom, otherwise as JSON
+
+        @param filename: Name of the file
+        """
+        report = self.report()
+        if filename.endswith(".prom"):
+            lines = [
+                "# TYPE hydrascrape_wall_time_seconds gauge",
+                f"hydrascrape_wall_time_seconds {report['wall_time']:.6f}",
+            ]
+            for counter, value in sorted(report["counters"].items()):
+                lines.append(f"# TYPE hydrascrape_{counter}_total counter")
+                lines.append(f"hydrascrape_{counter}_total {value}")
+            lines.append("# TYPE hydrascrape_phase_seconds summary")
+            for phase, stats in sorted(report["phases"].items()):
+                for quantile in ("0.5", "0.95"):
+                    value = stats["p50"] if quantile == "0.5" else stats["p95"]
+                    lines.append(
+                        f'hydrascrape_phase_seconds{{phase="{phase}",'
+                        f'quantile="{quantile}"}} {value:.6f}'
+                    )
+                lines.append(
+                    f'hydrascrape_phase_seconds_sum{{phase="{phase}"}} '
+                    f"{stats['total']:.6f}"
+                )
+                lines.append(
+                    f'hydrascrape_phase_seconds_count{{phase="{phase}"}} '
+                    f"{stats['count']}"
+                )
+            text = "\n".join(lines) + "\n"
+        else:
+            text = json.dumps(report, indent=2)
+
+        try:
+            with open(f"{filename}.tmp", "w", encoding="utf-8") as metrics_file:
+                metrics_file.write(text)
+            os.replace(f"{filename}.tmp", filename)
+
+        except PermissionError as perm_error:
+            print(f"Cannot write {filename}: {perm_error.strerror}", file=sys.stderr)
+
+
+class JsonWriter:
+    """Writer of build information in JSON format
+
+    Each build is written into <directory>/<Build ID>.json through a temporary
+    file which is renamed in place, so readers never see a partially written
+    file. Builds handled in a scan can also be written as an NDJSON file with
+    one compact JSON object per line.
+    """
+
+    def __init__(self, directory, compact=False, ndjson_file=None):
+        """Initialize writer and create the output directory
+
+        @param directory: Directory of build JSON files, None disables them
+        @param compact: Write JSON without indentation and extra spaces
+        @param ndjson_file: Name of NDJSON file of handled builds or None
+        """
+        self.directory = directory
+        self.compact = compact
+        self.ndjson_file = ndjson_file
+        if directory is not None:
+            try:
+                os.makedirs(directory, exist_ok=True)
+            except PermissionError as perm_error:
+                print(
+                    f"Could not create {perm_error.filename}: {perm_error.strerror}",
+                    file=sys.stderr,
+                )
+                sys.exit(1)
+
+    @staticmethod
+    def write_file(filename, text):
+        """Writes a file atomically
+
+        @param filename: Name of the file
+        @param text: Contents of the file
+        """
+        # Actions may be run concurrently, every thread has its own temporary file
+        tmpname = f"{filename}.{threading.get_ident()}.tmp"
+        try:
+            with open(tmpname, "w", encoding="utf-8") as outf:
+                outf.write(text)
+            os.replace(tmpname, filename)
+
+        except PermissionError as perm_error:
+            print(
+                f"Could not write {perm_error.filename}: {perm_error.strerror}",
+                file=sys.stderr,
+            )
+            sys.exit(1)
+
+    def write(self, binfo):
+        """Writes build information into a JSON file of the build
+
+        @param binfo: Dictionary containing build information
+        """
+        if self.directory is None:
+            return
+        filename = os.path.join(self.directory, f"{binfo['Build ID']}.json")
+        if DEBUG:
+            print(f"Writing json info into {filename}")
+
+        if self.compact:
+            text = json.dumps(binfo, separators=(",", ":"))
+        else:
+            text = json.dumps(binfo, indent=2)
+        self.write_file(filename, text)
+
+    def write_ndjson(self, binfos):
+        """Writes build information of handled builds into the NDJSON file
+
+        @param binfos: List of build information dictionaries
+        """
+        if self.ndjson_file is None:
+            return
+        if DEBUG:
+            print(f"Writing {len(binfos)} builds into {self.ndjson_file}")
+
+        self.write_file(
+            self.ndjson_file,
+            "".join(
+                json.dumps(binfo, separators=(",", ":")) + "\n" for binfo in binfos
+            ),
+        )
+
+
+def phase_timer(context, phase):
+    """Gets a context manager timing a phase of the scan
+
+    @param context: Connection context
+    @param phase: Name of the phase
+
+    @return: context manager
+    """
+    if context.get("metrics") is None:
+        return contextlib.nullcontext()
+    return context["metrics"].timer(phase)
+
+
+def count(context, counter, value=1):
+    """Adds given value to a statistics counter
+
+    @param context: Connection context
+    @param counter: Name of the counter
+    @param value: Value to add
+    """
+    if context.get("metrics") is not None:
+        context["metrics"].add(counter, value)
+
+
+def timed(phase):
+    """Decorator timing a function taking context as the first argument
+
+    @param phase: Name of the phase
+    """
+
+    def decorator(func):
+        @functools.wraps(func)
+        def wrapper(context, *args, **kwargs):
+            with phase_timer(context, phase):
+                return func(context, *args, **kwargs)
+
+        return wrapper
+
+    return decorator
+
+
+@timed("fetch")
+def get_page(context, url, headers=None, immutable=False):
     """Fetches a page from given web site
 
     @param context: Connection context
     @param url: URL of the page
+    @param headers: Request headers, context headers are used by default
+    @param immutable: Page is known not to change anymore and can be cached
+                      permanently
 
     @return: page data, on error returns empty page
     """
+    if headers is None:
+        headers = context["headers"]
+
+    cache = context.get("cache")
+    entry = None
+    request_headers = headers
+    if cache is not None:
+        entry = cache.get(url, headers)
+        if entry is not None:
+            meta, data = entry
+            if meta["immutable"]:
+                if DEBUG:
+                    print(f"Cached: {url}")
+                cache.count("hits")
+                count(context, "cache_hits")
+                return data
+
+            # Ask server whether cached page is still valid
+            request_headers = dict(headers)
+            if meta.get("etag"):
+                request_headers["If-None-Match"] = meta["etag"]
+            if meta.get("modified"):
+                request_headers["If-Modified-Since"] = meta["modified"]
+
     if DEBUG:
         print(f"Fetching: {url}")
 
-    req = urllib.request.Request(url, headers=context["headers"])
-    try:
-        response = urllib.request.urlopen(req)
-    except HTTPError as error:
-        print(f"HTTP error: {error}", file=sys.stderr)
+    response, text = context["client"].get(url, request_headers)
+    count(context, "requests")
+    count(context, "bytes", len(text))
+    if response.status == 304 and entry is not None:
+        cache.count("revalidated")
+        count(context, "cache_revalidated")
+        cache.put(url, headers, entry[1], dict(entry[0], immutable=immutable))
+        return entry[1]
+
+    if response.status >= 400:
+        print(f"HTTP error: {response.status} {response.reason}", file=sys.stderr)
+        if response.status == 404:
+            context["not_found"].add(url)
         return ""
 
     # Decompress if gzipped content
-    if response.info().get("Content-Encoding") == "gzip":
-        text = gzip.decompress(response.read())
-    elif response.info().get("Content-Encoding") == "deflate":
-        text = response.read()
-    elif response.info().get("Content-Encoding"):
+    if response.getheader("Content-Encoding") == "gzip":
+        text = gzip.decompress(text)
+    elif response.getheader("Content-Encoding") == "deflate":
+        pass
+    elif response.getheader("Content-Encoding"):
         print("Encoding type unknown", file=sys.stderr)
         return ""
-    else:
-        text = response.read()
+
+    if cache is not None and response.status == 200:
+        meta = {
+            "etag": response.getheader("ETag"),
+            "modified": response.getheader("Last-Modified"),
+            "immutable": immutable,
+        }
+        cache.put(url, headers, text, meta)
 
     return text
 
 
+def pin_page(context, url, headers=None):
+    """Marks a cached page immutable after it has been found to be final
+
+    @param context: Connection context
+    @param url: URL of the page
+    @param headers: Request headers, context headers are used by default
+    """
+    if context.get("cache") is not None:
+        context["cache"].pin(url, headers or context["headers"])
+
+
+def get_page_lines(context, url, keep=None, complete=None):
+    """Fetches a page line by line
+
+    The page is read, decompressed and decoded in chunks while lines are
+    consumed, so closing the generator early stops the download. Only the
+    lines accepted by keep are stored in the page cache, as that is all what
+    is needed from the page, so keep is only given for pages which do not
+    change anymore. Kept lines are stored when the whole page has been
+    read, or when the generator is closed early and complete tells that the
+    kept lines have everything needed.
+
+    @param context: Connection context
+    @param url: URL of the page
+    @param keep: Function telling if a line is stored in the page cache
+    @param complete: Function telling if list of kept lines is complete
+
+    @return: generator of lines without line endings, nothing on error
+    @raise FetchError: if the page could not be read completely
+    """
+    headers = context["headers"]
+    cache = context.get("cache")
+    if cache is not None:
+        entry = cache.get(url, headers)
+        if entry is not None and entry[0]["immutable"]:
+            if DEBUG:
+                print(f"Cached: {url}")
+            cache.count("hits")
+            count(context, "cache_hits")
+            yield from entry[1].decode("utf-8").split("\n")
+            return
+
+    if DEBUG:
+        print(f"Fetching: {url}")
+
+    kept = []
+    with contextlib.ExitStack() as stack:
+        with phase_timer(context, "fetch"):
+            response = stack.enter_context(context["client"].stream(url, headers))
+        count(context, "requests")
+
+        if response.status >= 400:
+            print(f"HTTP error: {response.status} {response.reason}", file=sys.stderr)
+            if response.status == 404:
+                context["not_found"].add(url)
+            return
+
+        encoding = response.getheader("Content-Encoding")
+        if encoding == "gzip":
+            decompressor = zlib.decompressobj(zlib.MAX_WBITS | 16)
+        elif encoding in (None, "deflate"):
+            decompressor = None
+        else:
+            print("Encoding type unknown", file=sys.stderr)
+            return
+
+        decoder = codecs.getincrementaldecoder("utf-8")(errors="replace")
+        pending = ""
+        try:
+            while True:
+                with phase_timer(context, "fetch"):
+                    try:
+                        chunk = response.read(LINE_CHUNK_SIZE)
+                    except (OSError, http.client.HTTPException) as error:
+                        raise FetchError(f"{url}: {error}") from error
+                count(context, "bytes", len(chunk))
+                # Connection closed before the whole body was received
+                if not chunk and response.length:
+                    raise FetchError(f"{url}: response truncated")
+                if decompressor is not None:
+                    try:
+                        if chunk:
+                            chunk = decompressor.decompress(chunk)
+                        elif decompressor.eof:
+                            chunk = decompressor.flush()
+                        else:
+                            raise FetchError(f"{url}: compressed data truncated")
+                    except zlib.error as error:
+                        raise FetchError(f"{url}: {error}") from error
+                lines = (pending + decoder.decode(chunk, final=not chunk)).split("\n")
+                pending = lines.pop()
+                for line in lines:
+                    if keep is not None and keep(line):
+                        kept.append(line)
+                    yield line
+                if not chunk:
+                    break
+            if keep is not None and keep(pending):
+                kept.append(pending)
+            yield pending
+
+        except GeneratorExit:
+            # Reading was stopped early, which is fine if all needed was found
+            if complete is not None and complete(kept):
+                put_lines(context, url, headers, kept)
+            raise
+
+        # Page was read completely
+        if keep is not None:
+            put_lines(context, url, headers, kept)
+
+
+def put_lines(context, url, headers, lines):
+    """Stores lines of a page which does not change anymore in page cache
+
+    @param context: Connection context
+    @param url: URL of the page
+    @param headers: Request headers
+    @param lines: List of lines
+    """
+    cache = context.get("cache")
+    if cache is not None:
+        meta = {"etag": None, "modified": None, "immutable": True}
+        cache.put(url, headers, "\n".join(lines).encode("utf-8"), meta)
+
+
+def get_json(context, url, immutable=False):
+    """Fetches a JSON document using Hydra's JSON API
+
+    @param context: Connection context
+    @param url: URL of the page
+    @param immutable: Document does not change anymore and can be cached
+
+    @return: decoded JSON data, on error returns None
+    """
+    text = get_page(context, url, context["json_headers"], immutable)
+    if not text:
+        return None
+
+    try:
+        return json.loads(text)
+    except ValueError as error:
+        print(f"Invalid JSON in {url}: {error}", file=sys.stderr)
+        return None
+
+
+def make_soup(context, text, parse_only=None):
+    """Parses a page with BeautifulSoup using the selected parser
+
+    The streaming parser is only used for build pages, other pages are
+    parsed with html.parser when it is selected.
+
+    @param context: Connection context
+    @param text: Page contents
+    @param parse_only: Optional SoupStrainer limiting the parsed elements
+
+    @return: Parsed page
+    """
+    features = "lxml" if context["parser"] == "lxml" else "html.parser"
+    return bs4.BeautifulSoup(text, features=features, parse_only=parse_only)
+
+
+def eval_pages(context, project, jobset):
+    """Generator of evaluation listing pages of given jobset
+
+    Pages are fetched only when needed, the first one usually being enough.
+
+    @param context: Connection context
+    @param project: Project name
+    @param jobset: Jobset name
+
+    @return: generator of lists of evaluation IDs, newest first
+    """
+    page = 1
+    while True:
+        # Jobset page shows fewer evaluations than the evaluations pages, so
+        # it cannot be used as the first page with the HTML backend either
+        url = f"{context['hydra_url']}jobset/{project}/{jobset}/evals"
+        if page > 1:
+            url += f"?page={page}"
+
+        if context["backend"] == "json":
+            data = get_json(context, url) or {}
+            evals = []
+            for evaluation in data.get("evals", []):
+                # Store evaluations so that get_builds does not need to fetch them again
+                context["evals"][evaluation["id"]] = evaluation
+                evals.append(evaluation["id"])
+            yield evals
+            if not data.get("next"):
+                return
+        else:
+            soup = make_soup(context, get_page(context, url))
+            evals = []
+            for link in soup.find_all("a", {"class": "row-link"}):
+                # Could also use the link as-is, but just to be safe side we create new link
+                evaluation = convert_int(link.text.strip(), -1)
+                if evaluation != -1:
+                    evals.append(evaluation)
+            yield evals
+
+        if not evals:
+            return
+        page += 1
+
+
+@timed("evals")
+def get_evals(context, project, jobset, last=0):
+    """Fetches evaluations of given jobset newer than the last known one
+
+    Evaluation listing is walked back page by page until the last known
+    evaluation is reached, at most eval pages pages. Only the first page is
+    fetched for jobsets without a known evaluation.
+
+    @param context: Connection context
+    @param project: Project name
+    @param jobset: Jobset name
+    @param last: ID of the last known evaluation, 0 if none
+
+    @return: a list of evaluation IDs, oldest first
+    """
+    evals = set()
+    pages = eval_pages(context, project, jobset)
+    with contextlib.closing(pages):
+        for number, page in enumerate(pages, 1):
+            evals.update(page)
+            if last == 0 or not page or min(page) <= last:
+                break
+            if number >= context["eval_pages"]:
+                print(
+                    f"{project}/{jobset}: evaluations older than {min(page)} "
+                    f"not checked, last known evaluation is {last}",
+                    file=sys.stderr,
+                )
+                break
+
+    return sorted(evals)
+
+
+def get_eval_json(context, evaluation):
+    """Gets evaluation data using Hydra's JSON API
+
+    @param context: Connection context
+    @param evaluation: Evaluation ID
+
+    @return: evaluation dictionary, on error returns an empty dictionary
+    """
+    data = context["evals"].get(evaluation)
+    if data is None:
+        data = get_json(context, f"{context['hydra_url']}eval/{evaluation}", True) or {}
+        context["evals"][evaluation] = data
+    return data
+
+
+@timed("builds")
 def get_builds(context, evaluation):
     """Fetches builds for given evaluation
 
     @param context: Connection context
 
-    @return: a list of build numbers
+    @return: a list of build numbers, None if the evaluation could not be read
     """
-    text = get_page(context, f"{context['hydra_url']}eval/{evaluation}")
-    soup = bs4.BeautifulSoup(text, features="html.parser")
+    if context["backend"] == "json":
+        data = get_eval_json(context, evaluation)
+        if "builds" not in data:
+            return None
+        builds = sorted(data["builds"])
+        if DEBUG:
+            for build in builds:
+                print(f"Found build {build}")
+            if len(builds) == 0:
+                print("No builds found")
+        return builds
+
+    # Builds of an evaluation do not change
+    text = get_page(context, f"{context['hydra_url']}eval/{evaluation}", immutable=True)
+    if not text:
+        return None
+    soup = make_soup(context, text)
 
     builds = []
     for link in reversed(soup.find_all("a", {"class": "row-link"})):
@@ -125,32 +1191,42 @@ def get_builds(context, evaluation):
     return builds
 
 
-def get_handled(filename):
+def get_handled(filename, compact=True):
     """Reads handled builds from handled builds file
 
+    The file is a journal with one build number per line, new builds are
+    appended to it and it is compacted when it has enough redundant lines.
+
     @param filename: Name of the handled builds file
+    @param compact: Compact the file if needed
 
-    @return: a list of build numbers
+    @return: a set of build numbers
     """
-    handled = []
+    handled = set()
+    redundant = 0
     try:
         with open(filename, "r", encoding="utf-8") as handled_file:
-            file_lines = handled_file.read()
-            build_ids = file_lines.split("\n")
-
-        for bid in build_ids:
-            if bid != "":
+            previous = -1
+            for line in handled_file:
+                bid = line.strip()
+                if bid == "":
+                    continue
                 as_int = convert_int(bid, -1)
-                if as_int != -1:
-                    handled.append(as_int)
-                else:
+                if as_int == -1:
                     print(
                         f"Weird build number in handled builds file: {bid}",
                         file=sys.stderr,
                     )
+                    redundant += 1
+                    continue
+                # Count duplicate and unsorted lines
+                if as_int <= previous:
+                    redundant += 1
+                previous = as_int
+                handled.add(as_int)
 
         if DEBUG:
-            print(f"handled = {handled}")
+            print(f"handled = {sorted(handled)}")
 
     except FileNotFoundError:
         if DEBUG:
@@ -160,58 +1236,134 @@ def get_handled(filename):
         print(f"Cannot read {filename}: {perm_error.strerror}", file=sys.stderr)
         sys.exit(1)
 
+    if compact and redundant >= COMPACT_LIMIT:
+        if DEBUG:
+            print(f"Compacting {filename}, {redundant} redundant lines")
+        update_handled(filename, handled)
+
     return handled
 
 
+def append_handled(filename, builds):
+    """Appends new handled builds into handled builds file
+
+    @param filename: name of the handled builds file
+    @param builds: list of new handled build numbers
+    """
+    if len(builds) == 0:
+        return
+
+    try:
+        with open(filename, "a", encoding="utf-8") as handled_file:
+            handled_file.write("".join(f"{build}\n" for build in sorted(builds)))
+
+    except PermissionError as perm_error:
+        print(f"Cannot update {filename}: {perm_error.strerror}", file=sys.stderr)
+        sys.exit(1)
+
+
 def update_handled(filename, handled):
-    """Writes handled builds into handled builds file
+    """Rewrites handled builds file atomically with sorted build numbers
 
     @param filename: name of the handled builds file
-    @param handled: list of handled build numbers
+    @param handled: set of handled build numbers
     """
-    handled.sort()
     try:
-        with open(filename, "w", encoding="utf-8") as handled_file:
-            for build in handled:
+        with open(f"{filename}.tmp", "w", encoding="utf-8") as handled_file:
+            for build in sorted(handled):
                 handled_file.write(f"{build}\n")
+        os.replace(f"{filename}.tmp", filename)
 
     except PermissionError as perm_error:
         print(f"Cannot update {filename}: {perm_error.strerror}", file=sys.stderr)
         sys.exit(1)
 
 
-def get_postbuild_info(context: dict, log_hash: str, binfo: dict):
-    """Get info provided by the Hydra postbuild script"""
-    # Get run command log by hash
-    text = get_page(context, f"{context['hydra_url']}runcommandlog/{log_hash}")
-    # Convert bytes to string
-    text = text.decode("utf-8")
-    # Create regex pattern that matches simple variable="value" assignments
-    pat = re.compile('^.*=".*"$')
+def get_state(filename):
+    """Reads scraper state saved next to the handled builds file
 
-    # Handle line by line
-    for line in text.split("\n"):
-        # Throw away extra spaces
-        line = line.strip()
-        # If pattern matches store the value in binfo
-        if pat.match(line):
-            varname = line.split("=")[0].lower().capitalize().replace("_", " ")
-            value = line.split('"')[1]
-            binfo[varname] = value
+    @param filename: Name of the state file
 
-    binfo["RunCommand status"] = "Succeeded"
+    @return: state dictionary, empty if there is no saved state
+    """
+    try:
+        with open(filename, "r", encoding="utf-8") as state_file:
+            return json.load(state_file)
 
+    except FileNotFoundError:
+        if DEBUG:
+            print(f"{filename} not found")
 
-# Constant data used by following get_build_info function
-summarykeys = {
-    "Build ID": 0,
-    "Status": 1,
-    "System": 0,
-    "Nix name": 0,
-    "Nr": -1,
-}
-detailkeys = [
-    "Queued at",
+    except ValueError as error:
+        print(f"Ignoring invalid state file {filename}: {error}", file=sys.stderr)
+
+    except PermissionError as perm_error:
+        print(f"Cannot read {filename}: {perm_error.strerror}", file=sys.stderr)
+        sys.exit(1)
+
+    return {}
+
+
+def update_state(filename, state):
+    """Writes scraper state atomically into state file
+
+    @param filename: Name of the state file
+    @param state: State dictionary
+    """
+    try:
+        with open(f"{filename}.tmp", "w", encoding="utf-8") as state_file:
+            json.dump(state, state_file, indent=2)
+        os.replace(f"{filename}.tmp", filename)
+
+    except PermissionError as perm_error:
+        print(f"Cannot update {filename}: {perm_error.strerror}", file=sys.stderr)
+        sys.exit(1)
+
+
+@timed("postbuild_info")
+def get_postbuild_info(context: dict, log_hash: str, binfo: dict):
+    """Get info provided by the Hydra postbuild script"""
+    # Create regex pattern that matches simple variable="value" assignments
+    pat = re.compile('^.*=".*"$')
+    found = set()
+
+    # Get run command log by hash and handle it line by line, the log is
+    # fetched only for finished run commands, so it does not change
+    lines = get_page_lines(
+        context,
+        f"{context['hydra_url']}runcommandlog/{log_hash}",
+        lambda line: pat.match(line.strip()),
+        lambda kept: POSTBUILD_LAST_VARS
+        <= {line.strip().split("=")[0] for line in kept},
+    )
+    with contextlib.closing(lines):
+        for line in lines:
+            # Throw away extra spaces
+            line = line.strip()
+            # If pattern matches store the value in binfo
+            if pat.match(line):
+                name = line.split("=")[0]
+                varname = name.lower().capitalize().replace("_", " ")
+                value = line.split('"')[1]
+                binfo[varname] = value
+                found.add(name)
+                # Rest of the log is not needed after the last expected variables
+                if found >= POSTBUILD_LAST_VARS:
+                    break
+
+    binfo["RunCommand status"] = "Succeeded"
+
+
+# Constant data used by following get_build_info function
+summarykeys = {
+    "Build ID": 0,
+    "Status": 1,
+    "System": 0,
+    "Nix name": 0,
+    "Nr": -1,
+}
+detailkeys = [
+    "Queued at",
     "Build started",
     "Build finished",
     "Short description",
@@ -225,16 +1377,339 @@ detailkeys = [
 ]
 
 
-def get_build_info(context, bnum):
-    """Fetches information for given build number
+# Build status texts matching the build status codes in Hydra's JSON API
+buildstatuses = {
+    0: "Success",
+    1: "Failed",
+    2: "Dependency failed",
+    3: "Aborted",
+    4: "Cancelled by user",
+    6: "Failed with output",
+    7: "Timed out",
+    9: "Unsupported system type",
+    10: "Log limit exceeded",
+    11: "Output limit exceeded",
+    12: "Non-determinism detected",
+}
+
+# Detail keys mapped to build fields in Hydra's JSON API
+detailfields = {
+    "Queued at": "timestamp",
+    "Build started": "starttime",
+    "Build finished": "stoptime",
+    "Short description": "description",
+    "License": "license",
+    "Homepage": "homepage",
+    "Maintainers": "maintainers",
+    "Derivation store path": "drvpath",
+}
+
+
+class BuildPageParser(html.parser.HTMLParser):
+    """Streaming parser for build pages
+
+    Collects the same build information as parse_build_page does with
+    BeautifulSoup in a single pass, keeping only the table cells of the
+    summary, details and build inputs tabs instead of a tree of the whole page.
+    Cells are stored as lists of their child nodes, so that values are picked
+    the same way as from the contents of a BeautifulSoup tag.
+    """
+
+    # Elements without an end tag
+    void_elements = {
+        "area",
+        "base",
+        "br",
+        "col",
+        "embed",
+        "hr",
+        "img",
+        "input",
+        "link",
+        "meta",
+        "param",
+        "source",
+        "track",
+        "wbr",
+    }
+
+    # Tab element IDs mapped to the sections of build information
+    sections = {
+        "tabs-summary": "summary",
+        "tabs-details": "details",
+        "tabs-buildinputs": "inputs",
+    }
+
+    def __init__(self):
+        super().__init__()
+        self.binfo = {}
+        self.inputs = []
+        self.job = None
+        self.runcommand_status = None
+        self.loghash = None
+
+        # Section and kind of every open div element
+        self.divs = []
+        # Summary headers after "Nr" are not used
+        self.summary_done = False
+        self.in_tbody = False
+        # Texts of the cells of the current build inputs row
+        self.row = None
+        # Currently parsed cell, its child nodes and depth of open elements
+        self.cell = None
+        self.children = []
+        self.depth = 0
+        # Header waiting for its value cell
+        self.header = None
+        # Text of page header, None when not inside it
+        self.job_text = None
+        # Run command div state
+        self.flex_row_seen = False
+        self.in_flex_row = False
+        self.status_seen = False
+        self.raw_link = None
+
+    @classmethod
+    def parse(cls, text):
+        """Parses a build page
+
+        @param text: Page contents as bytes or string
+
+        @return: parser containing the found information
+        """
+        parser = cls()
+        if isinstance(text, bytes):
+            text = text.decode("utf-8", errors="replace")
+        parser.feed(text)
+        parser.close()
+        return parser
+
+    def section(self):
+        """Gets the section of build information being parsed
+
+        @return: section name or None
+        """
+        return self.divs[-1][0] if self.divs else None
+
+    def handle_starttag(self, tag, attrs):
+        attrs = dict(attrs)
+        classes = (attrs.get("class") or "").split()
+
+        if self.cell is not None:
+            if self.depth == 0:
+                self.children.append((tag, attrs, []))
+            if tag not in self.void_elements:
+                self.depth += 1
+            return
+
+        if tag == "div":
+            kind = None
+            if "page-header" in classes and self.job is None and self.job_text is None:
+                kind = "header"
+                self.job_text = []
+            elif "flex-row" in classes and not self.flex_row_seen:
+                kind = "flex-row"
+                self.flex_row_seen = True
+                self.in_flex_row = True
+            section = self.sections.get(attrs.get("id"), self.section())
+            self.divs.append((section, kind))
+        elif self.in_flex_row:
+            self.runcommand_tag(tag, attrs, classes)
+        elif tag in ("th", "td") and self.section() in ("summary", "details"):
+            self.cell = tag
+        elif self.section() == "inputs":
+            if tag == "tbody":
+                self.in_tbody = True
+            elif tag == "tr" and self.in_tbody:
+                self.row = []
+            elif tag == "td" and self.row is not None:
+                self.cell = tag
+
+    def handle_startendtag(self, tag, attrs):
+        self.handle_starttag(tag, attrs)
+        if tag not in self.void_elements:
+            self.handle_endtag(tag)
+
+    def runcommand_tag(self, tag, attrs, classes):
+        """Handles a start tag inside the run command div
+
+        @param tag: Tag name
+        @param attrs: Tag attributes
+        @param classes: List of tag classes
+        """
+        if tag == "img" and "build-status" in classes and not self.status_seen:
+            self.status_seen = True
+            self.runcommand_status = attrs.get("title")
+        elif (
+            tag == "a"
+            and attrs.get("class") == "btn btn-secondary btn-sm"
+            and self.raw_link is None
+        ):
+            href = attrs.get("href")
+            if (
+                href is not None
+                and href.find("/runcommandlog/") != -1
+                and href.endswith("/raw")
+            ):
+                self.raw_link = href
+
+    def handle_endtag(self, tag):
+        if self.cell is not None:
+            if self.depth > 0:
+                if tag not in self.void_elements:
+                    self.depth -= 1
+                return
+            if tag != self.cell:
+                return
+            self.end_cell()
+            return
+
+        if tag == "div" and self.divs:
+            _, kind = self.divs.pop()
+            if kind == "header":
+                self.job = "".join(self.job_text).split(":")[-1].strip()
+                self.job_text = None
+            elif kind == "flex-row":
+                self.in_flex_row = False
+                if self.runcommand_status == "Succeeded" and self.raw_link:
+                    self.loghash = self.raw_link.split("/")[-2]
+        elif tag == "tbody":
+            self.in_tbody = False
+        elif tag == "tr" and self.row is None:
+            # Value cell must be in the same row as its header
+            self.header = None
+        elif tag == "tr":
+            if len(self.row) >= 4:
+                self.inputs.append(
+                    {"Name": self.row[0], "Hash": self.row[3], "Source": self.row[2]}
+                )
+            elif DEBUG:
+                print("Trouble getting build inputs")
+            self.row = None
+
+    def handle_data(self, data):
+        if self.job_text is not None:
+            self.job_text.append(data)
+        if self.cell is None:
+            return
+        if self.depth > 0:
+            self.children[-1][2].append(data)
+        elif self.children and self.children[-1][0] is None:
+            self.children[-1][2].append(data)
+        else:
+            self.children.append((None, {}, [data]))
+
+    def end_cell(self):
+        """Stores the value of a finished table cell"""
+        cell, children = self.cell, self.children
+        self.cell, self.children, self.depth = None, [], 0
+        text = "".join(part for child in children for part in child[2])
+
+        if self.row is not None:
+            self.row.append(text.strip())
+        elif cell == "th":
+            self.header = text
+        elif self.header is not None:
+            self.header_value(self.header, children)
+            self.header = None
+
+    def header_value(self, header, children):
+        """Stores build information from a header and its value cell
+
+        @param header: Header text
+        @param children: Child nodes of the value cell
+        """
+        if self.section() == "summary":
+            hdr = header.strip().rstrip(":")
+            index = summarykeys.get(hdr)
+            if index is None or self.summary_done:
+                return
+            if index == -1:
+                self.summary_done = True
+                return
+        else:
+            hdr = header.strip().rstrip(":").replace("(", "").replace(")", "")
+            if hdr not in detailkeys:
+                return
+            index = 0
+
+        if index >= len(children):
+            if DEBUG:
+                print(f"Trouble getting {hdr}")
+            return
+        tag, attrs, text = children[index]
+        if tag == "time":
+            self.binfo[hdr] = attrs.get("data-timestamp")
+        elif self.section() == "summary":
+            self.binfo[hdr] = "".join(text).strip()
+        else:
+            val = "".join(text).split("\n")[0].strip()
+            if val != "not given":
+                self.binfo[hdr] = val
+
+    def close(self):
+        super().close()
+        if self.inputs:
+            self.binfo["Inputs"] = self.inputs
+        if self.job is not None:
+            self.binfo["Job"] = self.job
+
+
+def get_runcommand(soup):
+    """Finds run command status and log hash from a build page
+
+    @param soup: Parsed build page
+
+    @return: tuple of run command status and log hash (both may be None)
+    """
+    loghash = None
+    status_text = None
+    row = soup.find("div", {"class": "flex-row"})
+    if row is not None:
+        status = row.find("img", {"class": "build-status"})
+        status_text = status.get("title") if status is not None else None
+        if status_text == "Succeeded":
+            for link in row.find_all("a", {"class": "btn btn-secondary btn-sm"}):
+                href = link.get("href")
+                if (
+                    href is not None
+                    and href.find("/runcommandlog/") != -1
+                    and href.endswith("/raw")
+                ):
+                    loghash = href.split("/")[-2]
+                    # break when raw is found we don't need anything else
+                    break
+
+    return status_text, loghash
+
+
+def build_final(binfo):
+    """Checks whether build information will not change anymore
+
+    @param binfo: Dictionary containing build information
+
+    @return: True if the build and its run commands have finished
+    """
+    status = binfo.get("Status")
+    if status in (None, "Scheduled to be built", "Build in progress"):
+        return False
+    return status != "Success" or binfo["RunCommand status"] is not None
+
+
+def parse_build_page(context, text):
+    """Parses build information from a build page
 
     @param context: Connection context
-    @param bnum: Build ID
+    @param text: Build page contents
 
-    @return a dictionary with information of the build
+    @return: tuple of build information dictionary, run command status and
+             run command log hash (status and hash may be None)
     """
-    text = get_page(context, f"{context['hydra_url']}build/{bnum}")
-    soup = bs4.BeautifulSoup(text, features="html.parser")
+    if context["parser"] == "stream":
+        parser = BuildPageParser.parse(text)
+        return parser.binfo, parser.runcommand_status, parser.loghash
+
+    soup = make_soup(context, text)
 
     binfo = {}
 
@@ -290,36 +1765,173 @@ def get_build_info(context, bnum):
                         print("Trouble getting build inputs")
     if len(inputs) > 0:
         binfo["Inputs"] = inputs
-    binfo["Output store paths"] = binfo["Output store paths"].split(" ")
     binfo["Job"] = (
         soup.find("div", {"class": "page-header"}).text.split(":")[-1].strip()
     )
 
-    # Find run command log hash entries for build
+    return (binfo,) + get_runcommand(soup)
+
+
+def get_runcommand_status(context, bnum):
+    """Finds run command status and log hash from the start of a build page
+
+    The page is parsed while it is read and reading stops after the run
+    command block, so the rest of the page is not downloaded. Once the run
+    command has finished, the lines read are cached under a URL of their own,
+    as they are not the whole build page.
+
+    @param context: Connection context
+    @param bnum: Build ID
+
+    @return: tuple of run command status and log hash (both may be None)
+    """
+    url = f"{context['hydra_url']}build/{bnum}"
+    key = f"{url}#runcommand"
+    cache = context.get("cache")
+    entry = cache.get(key, context["headers"]) if cache is not None else None
+    if entry is not None:
+        if DEBUG:
+            print(f"Cached: {key}")
+        cache.count("hits")
+        count(context, "cache_hits")
+        lines = (line for line in entry[1].decode("utf-8").split("\n"))
+    else:
+        lines = get_page_lines(context, url)
+
+    parser = BuildPageParser()
+    read = []
+    with contextlib.closing(lines):
+        for line in lines:
+            read.append(line)
+            parser.feed(line + "\n")
+            if parser.flex_row_seen and not parser.in_flex_row:
+                break
+
+    status, loghash = parser.runcommand_status, parser.loghash
+    # Same condition as in build_final
+    if entry is None and status is not None and (status != "Succeeded" or loghash):
+        put_lines(context, key, context["headers"], read)
+    return status, loghash
+
+
+def get_build_info_json(context, bnum):
+    """Fetches information for given build number using Hydra's JSON API
+
+    @param context: Connection context
+    @param bnum: Build ID
+
+    @return a dictionary with information of the build
+    """
+    build = get_json(context, f"{context['hydra_url']}build/{bnum}")
+    if build is None:
+        return {}
+
+    binfo = {
+        "Build ID": str(build.get("id")),
+        "Status": "Scheduled to be built",
+        "System": build.get("system"),
+        "Nix name": build.get("nixname"),
+    }
+    if build.get("finished"):
+        binfo["Status"] = buildstatuses.get(build.get("buildstatus"), "Failed")
+
+    for key, field in detailfields.items():
+        val = build.get(field)
+        if val not in (None, "", 0):
+            binfo[key] = str(val)
+
+    outputs = build.get("buildoutputs", {})
+    binfo["Output store paths"] = [outputs[name]["path"] for name in sorted(outputs)]
+
+    # Same format as on the build page
+    if build.get("closuresize"):
+        binfo["Closure size"] = f"{build['closuresize'] / (1024 * 1024):.2f} MiB"
+    if build.get("size"):
+        binfo["Output size"] = f"{build['size'] / (1024 * 1024):.2f} MiB"
+
+    # Build inputs are inputs of the evaluation the build belongs to
+    inputs = []
+    evals = build.get("jobsetevals", [])
+    if len(evals) > 0:
+        evalinputs = get_eval_json(context, evals[0]).get("jobsetevalinputs", {})
+        for name, einput in sorted(evalinputs.items()):
+            inputs.append(
+                {
+                    "Name": name,
+                    "Hash": einput.get("revision") or "",
+                    "Source": einput.get("uri") or einput.get("value") or "",
+                }
+            )
+    if len(inputs) > 0:
+        binfo["Inputs"] = inputs
+    binfo["Job"] = build.get("job")
+
+    # Run command logs are not part of the build JSON in stock Hydra, start of
+    # the build page is read for succeeded builds instead
     loghash = None
     binfo["RunCommand status"] = None
-    row = soup.find("div", {"class": "flex-row"})
-    if row is not None:
-        status = row.find("img", {"class": "build-status"})
-        status_text = status.get("title") if status is not None else None
-        if status_text != "Succeeded":
-            binfo["RunCommand status"] = status_text
-        else:
-            for link in row.find_all("a", {"class": "btn btn-secondary btn-sm"}):
-                href = link.get("href")
-                if (
-                    href is not None
-                    and href.find("/runcommandlog/") != -1
-                    and href.endswith("/raw")
-                ):
-                    loghash = href.split("/")[-2]
-                    # break when raw is found we don't need anything else
-                    break
+    if "runcommandlogs" in build:
+        logs = build["runcommandlogs"]
+        if len(logs) > 0 and logs[0].get("end_time") is not None:
+            if logs[0].get("exit_code") == 0:
+                binfo["RunCommand status"] = "Succeeded"
+                loghash = logs[0].get("uuid")
+            else:
+                binfo["RunCommand status"] = "Failed"
+    elif binfo["Status"] == "Success":
+        status, loghash = get_runcommand_status(context, bnum)
+        if status != "Succeeded":
+            binfo["RunCommand status"] = status
+
+    # If found, then process log for post build data
+    if loghash is not None:
+        get_postbuild_info(context, loghash, binfo)
+
+    if build_final(binfo):
+        pin_page(
+            context, f"{context['hydra_url']}build/{bnum}", context["json_headers"]
+        )
+
+    return binfo
+
+
+@timed("build_info")
+def get_build_info(context, bnum):
+    """Fetches information for given build number
+
+    @param context: Connection context
+    @param bnum: Build ID
+
+    @return a dictionary with information of the build
+    """
+    if context["backend"] == "json":
+        return get_build_info_json(context, bnum)
+
+    text = get_page(context, f"{context['hydra_url']}build/{bnum}")
+    # Build may have been removed after its evaluation was read, it is skipped
+    # like with the JSON API
+    if not text:
+        return {}
+
+    try:
+        binfo, status, loghash = parse_build_page(context, text)
+        binfo["Output store paths"] = binfo["Output store paths"].split(" ")
+    except (AttributeError, KeyError):
+        print(f"Cannot parse build page of build {bnum}", file=sys.stderr)
+        return {}
+
+    # Run command log hash was found on the build page
+    binfo["RunCommand status"] = None
+    if status != "Succeeded":
+        binfo["RunCommand status"] = status
 
     # If found, then process log for post build data
     if loghash is not None:
         get_postbuild_info(context, loghash, binfo)
 
+    if build_final(binfo):
+        pin_page(context, f"{context['hydra_url']}build/{bnum}")
+
     return binfo
 
 
@@ -358,309 +1970,1211 @@ def set_env(binfo):
     return env
 
 
-def save_json(binfo):
-    """Saves given given build information dictionary in json format
+def handoff_env(binfo):
+    """Writes build information into a temporary JSON file for the action
 
     @param binfo: Dictionary containing build information
+
+    @return: tuple of environment dictionary and name of the file,
+             the caller removes the file after running the action
+    """
+    fd, filename = tempfile.mkstemp(
+        prefix=f"hydra-{binfo['Build ID']}-", suffix=".json"
+    )
+    with os.fdopen(fd, "w", encoding="utf-8") as outf:
+        json.dump(binfo, outf, separators=(",", ":"))
+
+    env = os.environ.copy()
+    env["HYDRA_BUILDINFO_JSON"] = filename
+    return env, filename
+
+
+@timed("projects")
+def get_projects(context):
+    """Gets projects from a hydra site
+    @param context: Connection context
     """
-    filename = f"{binfo['Server']}/{binfo['Build ID']}.json"
+    if context["backend"] == "json":
+        plist = []
+        for proj in get_json(context, context["hydra_url"]) or []:
+            if proj.get("hidden") and context["hid_proj"] is False:
+                continue
+            if not proj.get("enabled") and context["dis_proj"] is False:
+                continue
+            plist.append(proj["name"])
+
+        if DEBUG:
+            print("Found projects: ", plist)
+
+        return plist
+
+    text = get_page(context, context["hydra_url"])
+    soup = make_soup(context, text)
+
+    projects = soup.find_all("tr", {"class": "project"})
+    hiddens = soup.find_all("span", {"class": "hidden-project"})
+    disableds = soup.find_all("span", {"class": "disabled-project"})
+
+    plist = []
+    for proj in projects:
+        plist.append(proj.find("a", {"class": "row-link"})["href"].split("/")[-1])
+
+    hlist = []
+    for proj in hiddens:
+        hlist.append(proj.find("a", {"class": "row-link"})["href"].split("/")[-1])
+
+    dlist = []
+    for proj in disableds:
+        dlist.append(proj.find("a", {"class": "row-link"})["href"].split("/")[-1])
+
+    if context["hid_proj"] is False:
+        for proj in hlist:
+            if proj in plist:
+                plist.remove(proj)
+
+    if context["dis_proj"] is False:
+        for proj in dlist:
+            if proj in plist:
+                plist.remove(proj)
+
     if DEBUG:
-        print(f"Writing json info into {filename}")
+        print("Found projects: ", plist)
 
-    json_obj = json.dumps(binfo, indent=2)
+    return plist
 
-    try:
-        if not os.path.exists(binfo["Server"]):
-            os.makedirs(binfo["Server"])
-        with open(filename, "w", encoding="utf-8") as outf:
-            outf.write(json_obj)
 
-    except PermissionError as perm_error:
-        print(
-            f"Could not write {perm_error.filename}: {perm_error.strerror}",
-            file=sys.stderr,
-        )
-        sys.exit(1)
+@timed("jobsets")
+def get_jobsets(context, project):
+    """Gets jobsets for a given hydra project
+
+    @param context: Connection context
+    """
+    # Project data lists only jobset names, hidden and disabled jobsets are
+    # found from the project page with one request instead of one per jobset
+    if context["backend"] == "json" and context["hid_jobset"] and context["dis_jobset"]:
+        data = get_json(context, f"{context['hydra_url']}project/{project}") or {}
+        jlist = data.get("jobsets", [])
+
+        if DEBUG:
+            print("Found jobsets: ", jlist)
+
+        return jlist
+
+    text = get_page(context, f"{context['hydra_url']}project/{project}")
+    soup = make_soup(context, text)
+
+    jobsets = soup.find_all("tr", {"class": "jobset"})
+    hiddens = soup.find_all("span", {"class": "hidden-jobset"})
+    disableds = soup.find_all("span", {"class": "disabled-jobset"})
+
+    jlist = []
+    for jobset in jobsets:
+        jlist.append(jobset.find("a", {"class": "row-link"})["href"].split("/")[-1])
+
+    hlist = []
+    for jobset in hiddens:
+        hlist.append(jobset.find("a", {"class": "row-link"})["href"].split("/")[-1])
+
+    dlist = []
+    for jobset in disableds:
+        dlist.append(jobset.find("a", {"class": "row-link"})["href"].split("/")[-1])
+
+    if context["hid_jobset"] is False:
+        for jobset in hlist:
+            if jobset in jlist:
+                jlist.remove(jobset)
+
+    if context["dis_jobset"] is False:
+        for jobset in dlist:
+            if jobset in jlist:
+                jlist.remove(jobset)
+
+    if DEBUG:
+        print("Found jobsets: ", jlist)
+
+    return jlist
+
+
+def run_action(context, binfo):
+    """Runs the user specified action for a build
+
+    @param context: Connection context
+    @param binfo: Dictionary containing build information
+
+    @return: True if the action was successful
+    """
+    i = binfo["Build ID"]
+    handoff_file = None
+    with phase_timer(context, "set_env"):
+        if context["handoff"]:
+            env, handoff_file = handoff_env(binfo)
+        else:
+            env = set_env(binfo)
+    with phase_timer(context, "save_json"):
+        context["json_writer"].write(binfo)
+
+    try:
+        returncode = run_process(context, f"build {i}", env)
+    finally:
+        if handoff_file is not None:
+            os.remove(handoff_file)
+
+    if returncode is None:
+        return False
+    if returncode == 0:
+        if DEBUG:
+            print(f"Handling {i} successful " + "-" * 50)
+        return True
+
+    if DEBUG:
+        print(f"Action for build {i} failed with code: {returncode}")
+    return False
+
+
+def run_process(context, name, env):
+    """Runs the user specified action process
+
+    @param context: Connection context
+    @param name: What the action is run for, used in messages
+    @param env: Environment of the action
+
+    @return: exit code of the action, None if it timed out
+    """
+    with context["action_slots"]:
+        if DEBUG:
+            print(f"Handling {name} " + "-" * 60)
+
+        # Run the user specified action with build info in environment,
+        # in its own session when it may need to be killed on timeout
+        with phase_timer(context, "action"), subprocess.Popen(
+            context["action"],
+            shell=True,
+            env=env,
+            start_new_session=context["timeout"] is not None,
+        ) as proc:
+            try:
+                returncode = proc.wait(timeout=context["timeout"])
+            except subprocess.TimeoutExpired:
+                os.killpg(proc.pid, signal.SIGKILL)
+                proc.wait()
+                print(f"Action for {name} timed out", file=sys.stderr)
+                return None
+
+    return returncode
+
+
+def run_batch_action(context, binfos):
+    """Runs the user specified action once for given builds
+
+    Build information is passed as an NDJSON file named in
+    HYDRA_BUILDS_NDJSON, in the order the builds should be handled. The
+    action writes IDs of the builds it is done with, one per line, into the
+    file named in HYDRA_BUILDS_RESULT. Only those builds are marked handled,
+    also when the action fails or times out.
+
+    @param context: Connection context
+    @param binfos: List of build information dictionaries
+
+    @return: list of builds handled successfully
+    """
+    if not binfos:
+        return []
+
+    with phase_timer(context, "set_env"):
+        fd, builds_file = tempfile.mkstemp(prefix="hydra-builds-", suffix=".ndjson")
+        with os.fdopen(fd, "w", encoding="utf-8") as outf:
+            for binfo in binfos:
+                outf.write(json.dumps(binfo, separators=(",", ":")) + "\n")
+        fd, results_file = tempfile.mkstemp(prefix="hydra-results-", suffix=".txt")
+        os.close(fd)
+        env = os.environ.copy()
+        env["HYDRA_BUILDS_NDJSON"] = builds_file
+        env["HYDRA_BUILDS_RESULT"] = results_file
+    with phase_timer(context, "save_json"):
+        for binfo in binfos:
+            context["json_writer"].write(binfo)
+
+    try:
+        returncode = run_process(context, f"batch of {len(binfos)} builds", env)
+        with open(results_file, "r", encoding="utf-8") as inf:
+            done = {convert_int(line, -1) for line in inf}
+    finally:
+        os.remove(builds_file)
+        os.remove(results_file)
+
+    if DEBUG:
+        print(f"Batch action exited with code {returncode}, {len(done)} builds done")
+
+    return [
+        convert_int(binfo["Build ID"])
+        for binfo in binfos
+        if convert_int(binfo["Build ID"]) in done
+    ]
+
+
+def build_priority(context, binfo):
+    """Gets priority of a build, the highest priority of the patterns
+    found in project:jobset:job name of the build
+
+    @param context: Connection context
+    @param binfo: Dictionary containing build information
+
+    @return: priority, 0 if no pattern matched
+    """
+    name = f"{binfo['Project']}:{binfo['Jobset']}:{binfo.get('Job')}"
+    priorities = [prio for regex, prio in context["priorities"] if regex.search(name)]
+    return max(priorities, default=0)
+
+
+def schedule(context, binfos):
+    """Orders builds for running the actions, highest priority first, then
+    the ones queued first and lowest build ID first
+
+    @param context: Connection context
+    @param binfos: List of build information dictionaries
+
+    @return: sorted list of build information dictionaries
+    """
+    binfos = sorted(
+        binfos,
+        key=lambda binfo: (
+            -build_priority(context, binfo),
+            convert_int(binfo.get("Queued at"), sys.maxsize),
+            convert_int(binfo["Build ID"]),
+        ),
+    )
+    if DEBUG and binfos:
+        print("Build order: ", [binfo["Build ID"] for binfo in binfos])
+    return binfos
+
+
+def run_actions(context, binfos):
+    """Runs the user specified action for given builds
+
+    @param context: Connection context
+    @param binfos: List of build information dictionaries
+
+    @return: list of builds handled successfully
+    """
+    if context["parallel"] == 1:
+        results = [run_action(context, binfo) for binfo in binfos]
+    else:
+        # Each project gets its own workers so that projects at their limit
+        # do not block actions of other projects, total number of running
+        # actions is limited by the action slots
+        workers = context["project_limit"] or context["parallel"]
+        executors = {}
+        futures = []
+        for binfo in binfos:
+            project = binfo["Project"]
+            if project not in executors:
+                executors[project] = ThreadPoolExecutor(max_workers=workers)
+            futures.append(executors[project].submit(run_action, context, binfo))
+
+        results = [future.result() for future in futures]
+        for executor in executors.values():
+            executor.shutdown()
+
+    return [
+        convert_int(binfo["Build ID"])
+        for binfo, result in zip(binfos, results)
+        if result
+    ]
+
+
+def update_cursors(context, handled, jobsets):
+    """Moves evaluation cursors past handled evaluations and keeps track of
+    the evaluations which still have unhandled builds or could not be read
+
+    Evaluations which have been removed are not kept pending, and cursors
+    of jobsets which are not selected anymore are dropped.
+
+    @param context: Connection context
+    @param handled: set of handled builds
+    @param jobsets: dictionary of selected jobsets for each selected project
+    """
+    cursors = context["state"]["evals"]
+    selected = {f"{proj}/{jobset}" for proj in jobsets for jobset in jobsets[proj]}
+    for key in set(cursors) - selected:
+        if DEBUG:
+            print(f"Jobset {key} not selected anymore, dropping its cursor")
+        del cursors[key]
+
+    for key, last, evals, eval_builds in context["cursors"]:
+        removed = {
+            e
+            for e in evals
+            if f"{context['hydra_url']}eval/{e}" in context["not_found"]
+        }
+        cursors[key] = {
+            "last": max([last] + evals),
+            "pending": [
+                e
+                for e in evals
+                if e not in removed
+                and (
+                    eval_builds[e] is None
+                    or not all(b in handled for b in eval_builds[e])
+                )
+            ],
+        }
+
+
+def plan_build(context, section, i, project, jobset, reason):
+    """Adds a build to a section of the plan when planning
+
+    @param context: Connection context
+    @param section: Section of the plan, "skip" or "mark_handled"
+    @param i: Build ID
+    @param project: Project name
+    @param jobset: Jobset name
+    @param reason: Reason for skipping or marking handled
+    """
+    if context["plan_en"]:
+        context["plan"][section].append(
+            {"Build ID": i, "Project": project, "Jobset": jobset, "Reason": reason}
+        )
+
+
+def handle_jobset(context, project, jobset, handled):
+    """Handles a given jobset of given project
+
+    Builds which do not need an action are marked handled right away,
+    builds needing the action are returned for running it later.
+
+    @param context: Connection context
+    @param project: Project name
+    @param jobset: Jobset name
+    @param handled: set of handled builds
+
+    @return: tuple of list of handled builds and list of build information
+             dictionaries of builds to run the action for
+    """
+    # Evaluations up to the cursor have been handled already, except for the
+    # pending ones which still had unfinished builds on previous run
+    cursor = context["state"].setdefault("evals", {}).get(f"{project}/{jobset}", {})
+    last = cursor.get("last", 0)
+    pending = cursor.get("pending", [])
+
+    evals = get_evals(context, project, jobset, last)
+    # After builds have been removed from handled builds file, also the
+    # evaluations before the cursor are read again
+    new_evals = [
+        e for e in evals if (context["rescan"] or e > last) and e not in pending
+    ]
+    if DEBUG:
+        print(f"New evaluations: {new_evals}, pending evaluations: {pending}")
+    evals = sorted(pending) + new_evals
+
+    eval_builds = dict(
+        zip(evals, context["pool"].map(lambda e: get_builds(context, e), evals))
+    )
+
+    builds = []
+    for evaluation in evals:
+        builds += eval_builds[evaluation] or []
+
+    # Remove duplicates
+    builds = list(dict.fromkeys(builds))
+
+    todo = []
+    for i in builds:
+        if i not in handled:
+            todo.append(i)
+        elif DEBUG:
+            print(f"Build {i} already handled")
+
+    # Fetch build information concurrently, map returns the results in the
+    # same order as the builds were given so actions are run in build order
+    binfos = context["pool"].map(lambda b: get_build_info(context, b), todo)
+
+    new_handled = []
+    to_run = []
+
+    for i, binfo in zip(todo, binfos):
+        buildid = convert_int(binfo.get("Build ID"), -1)
+
+        if buildid != i:
+            if DEBUG:
+                print(
+                    f"Build ID mismatch: build id on page = {buildid}, "
+                    f"build id requested = {i}, skipping"
+                )
+            plan_build(context, "skip", i, project, jobset, "Build ID mismatch")
+            continue
+
+        status = binfo.get("Status", "Unknown")
+
+        if status in ("Scheduled to be built", "Build in progress"):
+            if DEBUG:
+                print(f"Build {i} not finished yet, skipping")
+            plan_build(context, "skip", i, project, jobset, status)
+            context["queued"] += 1
+            continue
+
+        if status == "Success":
+            # check postbuild status for succeeded builds only
+            runcmd_status = binfo["RunCommand status"]
+            if runcmd_status is None:
+                if DEBUG:
+                    print(f"RunCommands for build {i} are not finished yet, skipping")
+                plan_build(context, "skip", i, project, jobset, "RunCommand pending")
+                context["queued"] += 1
+                continue
+
+            elif runcmd_status != "Succeeded":
+                # if there is a status but it was not success,
+                # there is no need to retry later. just mark as handled.
+                if DEBUG:
+                    print(
+                        f"RunCommands for build {i} {runcmd_status}, "
+                        "marking as handled"
+                    )
+                plan_build(
+                    context,
+                    "mark_handled",
+                    i,
+                    project,
+                    jobset,
+                    f"RunCommand {runcmd_status}",
+                )
+                new_handled.append(i)
+                continue
+
+            binfo["Server"] = context["server"]
+            binfo["Project"] = project
+            binfo["Jobset"] = jobset
+            del binfo["Status"]
+            to_run.append(binfo)
+        else:
+            if DEBUG:
+                print(f"Build {i} has failed, just marking as handled")
+            plan_build(context, "mark_handled", i, project, jobset, status)
+            new_handled.append(i)
+
+    if context["plan_en"]:
+        context["plan"]["evaluations"] += len(evals)
+        context["plan"]["builds"] += len(todo)
+
+    # Cursor is moved when the actions have been run
+    context["cursors"].append((f"{project}/{jobset}", last, evals, eval_builds))
+
+    return new_handled, to_run
+
+
+def discover(context):
+    """Finds selected projects and their selected jobsets
+
+    Results are cached in the state for discovery TTL seconds.
+
+    @param context: Connection context
+
+    @return: dictionary of selected jobsets for each selected project
+    """
+    cached = context["state"].setdefault("discovery", {}).get(context["discovery_key"])
+    if cached is not None and time.time() - cached["time"] < context["discovery_ttl"]:
+        if DEBUG:
+            print("Using cached projects and jobsets: ", cached["jobsets"])
+        return cached["jobsets"]
+
+    projects = get_projects(context)
+    projects = list(filter(context["re_p"].match, projects))
+    if DEBUG:
+        print("Selected projects: ", projects)
+
+    jobsets = {}
+    for proj in projects:
+        jobsets[proj] = get_jobsets(context, proj)
+
+    for proj in projects:
+        jobsets[proj] = list(filter(context["re_js"].match, jobsets[proj]))
+        if DEBUG:
+            print(f"{proj} selected jobsets: {jobsets[proj]}")
+
+    context["state"]["discovery"][context["discovery_key"]] = {
+        "time": time.time(),
+        "jobsets": jobsets,
+    }
+    return jobsets
+
+
+def scan(context, handled):
+    """Scans selected projects and jobsets once and handles new builds
+
+    @param context: Connection context
+    @param handled: set of handled builds, updated with new handled builds
+
+    @return: tuple of number of new handled builds and number of builds
+             which are not finished yet
+    """
+    context["evals"] = {}
+    context["cursors"] = []
+    context["queued"] = 0
+    context["not_found"] = set()
+    context["metrics"] = Metrics()
+    client = context["client"]
+    opened, reused, retried = client.opened, client.reused, client.retried
+    handled_count = len(handled)
+
+    with ThreadPoolExecutor(max_workers=context["jobs"]) as pool:
+        context["pool"] = pool
+
+        jobsets = discover(context)
+
+        to_run = []
+        for project, project_jobsets in jobsets.items():
+            for jobset in project_jobsets:
+                new_handled, jobset_to_run = handle_jobset(
+                    context, project, jobset, handled
+                )
+                handled.update(new_handled)
+                append_handled(context["handled_file"], new_handled)
+                to_run += jobset_to_run
+
+    # Builds of all jobsets are gathered first, so that the most important
+    # ones get handled first
+    to_run = schedule(context, to_run)
+    if context["batch"]:
+        new_handled = run_batch_action(context, to_run)
+    else:
+        new_handled = run_actions(context, to_run)
+    handled.update(new_handled)
+    append_handled(context["handled_file"], new_handled)
+
+    succeeded = set(new_handled)
+    with phase_timer(context, "save_json"):
+        context["json_writer"].write_ndjson(
+            [
+                binfo
+                for binfo in sorted(to_run, key=lambda b: convert_int(b["Build ID"]))
+                if convert_int(binfo["Build ID"]) in succeeded
+            ]
+        )
+
+    update_cursors(context, handled, jobsets)
+    # Version of handled builds file tells on next scan if it has been edited
+    version = file_version(context["handled_file"])
+    context["state"]["handled_version"] = version and list(version)
+    context["rescan"] = False
+
+    # Jobset has been removed or renamed, refresh discovery on next scan
+    if any(
+        url.startswith(f"{context['hydra_url']}jobset/") for url in context["not_found"]
+    ):
+        if DEBUG:
+            print("Jobset not found, forgetting cached projects and jobsets")
+        context["state"]["discovery"].pop(context["discovery_key"], None)
+
+    update_state(f"{context['handled_file']}.state", context["state"])
+
+    if context.get("cache") is not None:
+        context["cache"].evict()
+
+    if DEBUG:
+        print(f"HTTP connections: {client.opened} opened, {client.reused} reused")
+        print(f"HTTP requests retried: {client.retried}")
+        if context.get("cache") is not None:
+            cache = context["cache"]
+            print(f"Page cache: {cache.hits} hits, {cache.revalidated} revalidated")
+
+    count(context, "connections_opened", client.opened - opened)
+    count(context, "connections_reused", client.reused - reused)
+    count(context, "requests_retried", client.retried - retried)
+    count(context, "builds_handled", len(handled) - handled_count)
+    count(context, "builds_queued", context["queued"])
+    if context["metrics_file"] is not None:
+        context["metrics"].write(context["metrics_file"])
+
+    return len(handled) - handled_count, context["queued"]
+
+
+def plan(context, handled):
+    """Finds builds like a scan but only reports what would be done
+
+    Actions are not run and handled builds, state and JSON files are not
+    written. Fetched pages are cached as usual, so planning also warms the
+    page cache for the real run.
+
+    @param context: Connection context
+    @param handled: set of handled builds
+    """
+    context["evals"] = {}
+    context["cursors"] = []
+    context["queued"] = 0
+    context["not_found"] = set()
+    context["metrics"] = Metrics()
+    context["plan"] = {"evaluations": 0, "builds": 0, "skip": [], "mark_handled": []}
+
+    with ThreadPoolExecutor(max_workers=context["jobs"]) as pool:
+        context["pool"] = pool
+
+        jobsets = discover(context)
+
+        to_run = []
+        for project, project_jobsets in jobsets.items():
+            for jobset in project_jobsets:
+                to_run += handle_jobset(context, project, jobset, handled)[1]
+
+    if context.get("cache") is not None:
+        context["cache"].evict()
+
+    counters = context["metrics"].report()["counters"]
+    report = {
+        "server": context["server"],
+        "handle": [
+            {
+                "Build ID": convert_int(binfo["Build ID"]),
+                "Project": binfo["Project"],
+                "Jobset": binfo["Jobset"],
+                "Job": binfo.get("Job"),
+                "Priority": build_priority(context, binfo),
+            }
+            for binfo in schedule(context, to_run)
+        ],
+        "skip": context["plan"]["skip"],
+        "mark_handled": context["plan"]["mark_handled"],
+        # Without the page cache a real run fetches the same pages again,
+        # with it finished builds are not fetched again
+        "fetches": {
+            "evaluations": context["plan"]["evaluations"],
+            "builds": context["plan"]["builds"],
+            "requests": counters.get("requests", 0),
+            "cache_hits": counters.get("cache_hits", 0),
+            "estimated_requests": counters.get("requests", 0)
+            + counters.get("cache_hits", 0),
+        },
+    }
+    # One write, so that reports of concurrent targets are not mixed
+    sys.stdout.write(json.dumps(report, indent=2) + "\n")
+    sys.stdout.flush()
+
+
+def start_trigger_server(port, triggers):
+    """Starts HTTP server on localhost which triggers a scan when requested
+
+    @param port: TCP port to listen
+    @param triggers: List of events to set when a scan is requested
+    """
+
+    class TriggerHandler(BaseHTTPRequestHandler):
+        """Sets the trigger on POST or GET of /scan"""
+
+        def do_POST(self):  # pylint: disable=invalid-name
+            """Handle POST request"""
+            if self.path != "/scan":
+                self.send_error(404)
+                return
+            for trigger in triggers:
+                trigger.set()
+            self.send_response(202)
+            self.send_header("Content-Length", "0")
+            self.end_headers()
+
+        do_GET = do_POST
+
+        def log_message(self, *_):
+            """Log only when debugging"""
+            if DEBUG:
+                BaseHTTPRequestHandler.log_message(self, *_)
+
+    server = ThreadingHTTPServer(("127.0.0.1", port), TriggerHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    if DEBUG:
+        print(f"Scan can be triggered at http://127.0.0.1:{port}/scan")
+
+
+def file_version(filename):
+    """Gets modification time and size of a file to notice changes
+
+    @param filename: Name of the file
+
+    @return: tuple of modification time and size, None if file does not exist
+    """
+    try:
+        stat = os.stat(filename)
+        return stat.st_mtime_ns, stat.st_size
+    except FileNotFoundError:
+        return None
+
+
+def run_daemon(context, handled):
+    """Scans repeatedly, keeping state in memory between the scans
+
+    Polling interval is doubled up to maximum interval every time when
+    nothing changed, and reset to minimum interval when builds were handled
+    or there are builds which are not finished yet.
+
+    @param context: Connection context
+    @param handled: set of handled builds
+    """
+    trigger = context["trigger"]
+    interval = context["min_interval"]
+    while True:
+        # Handled builds file may have been edited e.g. by unhandle.sh
+        if file_version(context["handled_file"]) != context["handled_version"]:
+            handled = get_handled(context["handled_file"])
+            context["rescan"] = True
+
+        try:
+            new, queued = scan(context, handled)
+        except (OSError, http.client.HTTPException, FetchError) as error:
+            print(f"Scan failed: {error}", file=sys.stderr)
+            new, queued = 0, 0
+
+        context["handled_version"] = file_version(context["handled_file"])
+
+        if new > 0 or queued > 0:
+            interval = context["min_interval"]
+        else:
+            interval = min(interval * 2, context["max_interval"])
+
+        if DEBUG:
+            print(f"{new} builds handled, {queued} builds queued")
+            print(f"Next scan in {interval} seconds")
+
+        if trigger.wait(interval):
+            if DEBUG:
+                print("Scan triggered")
+            trigger.clear()
+
+
+def main_locked(context):
+    """locked main program, called only if lock was aqcuired successfully
+
+    @param context: Connection context
+    """
+    context["hydra_url"] = f"{context['scheme']}://{context['server']}/"
+    context["headers"] = {
+        "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
+        "Accept-Encoding": "gzip, deflate",
+        "User-Agent": "hydrascraper.py v1.0",
+    }
+
+    context["json_headers"] = dict(context["headers"], Accept="application/json")
+
+    # Discovery results depend on the server and the search options
+    context["discovery_key"] = " ".join(
+        [
+            context["server"],
+            context["re_p"].pattern,
+            context["re_js"].pattern,
+            "".join(
+                str(int(context[flag]))
+                for flag in ("hid_proj", "dis_proj", "hid_jobset", "dis_jobset")
+            ),
+        ]
+    )
+
+    context["state"] = get_state(f"{context['handled_file']}.state")
+    # Handled builds file edited after last scan, e.g. by unhandle.sh
+    version = file_version(context["handled_file"])
+    context["rescan"] = context["state"].get("handled_version") != (
+        version and list(version)
+    )
+    if DEBUG and context["rescan"]:
+        print("Handled builds file has changed, reading all evaluations again")
+
+    handled = get_handled(context["handled_file"], not context["plan_en"])
+    context["handled_version"] = file_version(context["handled_file"])
+
+    if context["plan_en"]:
+        plan(context, handled)
+    elif context["daemon"]:
+        run_daemon(context, handled)
+    else:
+        scan(context, handled)
+
+
+def json_e(context):
+    """Enable JSON output in context
+
+    @param context: Connection context
+    """
+    context["json_en"] = True
+    if DEBUG:
+        print("JSON enabled")
+
+
+def compact_e(context):
+    """Enable compact JSON output in context
+
+    @param context: Connection context
+    """
+    context["json_compact"] = True
+
+
+def debug_e(_):
+    """Set global debug flag"""
+    global DEBUG
+    DEBUG = 1
+    print("Debug enabled")
+
+
+def hp_e(context):
+    """Set hidden projects flag in context
+
+    @param context: Connection context
+    """
+    context["hid_proj"] = True
+    if DEBUG:
+        print("Including hidden projects")
+
+
+def dp_e(context):
+    """Set disabled projects flag in context
+
+    @param context: Connection context
+    """
+    context["dis_proj"] = True
+    if DEBUG:
+        print("Including disabled projects")
+
+
+def hj_e(context):
+    """Set hidden jobsets flag in context
+
+    @param context: Connection context
+    """
+    context["hid_jobset"] = True
+    if DEBUG:
+        print("Including hidden jobsets")
+
+
+def dj_e(context):
+    """Set disabled jobsets flag in context
+
+    @param context: Connection context
+    """
+    context["dis_jobset"] = True
+    if DEBUG:
+        print("Including disabled jobsets")
+
+
+def positive_int(name, value):
+    """Convert option value to a positive integer, exit if invalid
+
+    @param name: Description of the value for error message
+    @param value: Option value
+
+    @return: the integer
+    """
+    i = convert_int(value, -1)
+    if i < 1:
+        print(f"Invalid {name}: {value}", file=sys.stderr)
+        sys.exit(1)
+    return i
+
+
+def parser_e(context, value):
+    """Set HTML parser in context
+
+    @param context: Connection context
+    @param value: html.parser, lxml or stream
+    """
+    if value not in ("html.parser", "lxml", "stream"):
+        print(f"Invalid parser: {value}", file=sys.stderr)
+        sys.exit(1)
+    if value == "lxml" and bs4.builder.builder_registry.lookup("lxml") is None:
+        print("Parser lxml is not installed", file=sys.stderr)
+        sys.exit(1)
+    context["parser"] = value
+    if DEBUG:
+        print(f"Using {value} parser")
+
+
+def html_e(context):
+    """Use HTML pages, the default
+
+    @param context: Connection context
+    """
+    context["backend"] = "html"
+    if DEBUG:
+        print("Parsing HTML pages")
+
+
+def jsonapi_e(context):
+    """Use JSON API instead of HTML pages
+
+    @param context: Connection context
+    """
+    context["backend"] = "json"
+    if DEBUG:
+        print("Using JSON API")
 
 
-def get_projects(context):
-    """Gets projects from a hydra site
+def http_e(context):
+    """Use plain HTTP instead of HTTPS
+
     @param context: Connection context
     """
-    text = get_page(context, context["hydra_url"])
-    soup = bs4.BeautifulSoup(text, features="html.parser")
-
-    projects = soup.find_all("tr", {"class": "project"})
-    hiddens = soup.find_all("span", {"class": "hidden-project"})
-    disableds = soup.find_all("span", {"class": "disabled-project"})
+    context["scheme"] = "http"
+    if DEBUG:
+        print("Using plain HTTP")
 
-    plist = []
-    for proj in projects:
-        plist.append(proj.find("a", {"class": "row-link"})["href"].split("/")[-1])
 
-    hlist = []
-    for proj in hiddens:
-        hlist.append(proj.find("a", {"class": "row-link"})["href"].split("/")[-1])
+def jobs_e(context, value):
+    """Set number of concurrent page fetches in context
 
-    dlist = []
-    for proj in disableds:
-        dlist.append(proj.find("a", {"class": "row-link"})["href"].split("/")[-1])
+    @param context: Connection context
+    @param value: Number of concurrent fetches
+    """
+    context["jobs"] = positive_int("number of jobs", value)
+    if DEBUG:
+        print(f"Fetching up to {value} pages concurrently")
 
-    if context["hid_proj"] is False:
-        for proj in hlist:
-            if proj in plist:
-                plist.remove(proj)
 
-    if context["dis_proj"] is False:
-        for proj in dlist:
-            if proj in plist:
-                plist.remove(proj)
+def cache_e(context, value):
+    """Set page cache directory in context
 
+    @param context: Connection context
+    @param value: Cache directory
+    """
+    context["cache_dir"] = value
     if DEBUG:
-        print("Found projects: ", plist)
-
-    return plist
+        print(f"Caching pages in {value}")
 
 
-def get_jobsets(context, project):
-    """Gets jobsets for a given hydra project
+def cachesize_e(context, value):
+    """Set maximum page cache size in context
 
     @param context: Connection context
+    @param value: Maximum size in megabytes
     """
-    text = get_page(context, f"{context['hydra_url']}project/{project}")
-    soup = bs4.BeautifulSoup(text, features="html.parser")
-
-    jobsets = soup.find_all("tr", {"class": "jobset"})
-    hiddens = soup.find_all("span", {"class": "hidden-jobset"})
-    disableds = soup.find_all("span", {"class": "disabled-jobset"})
+    size = convert_int(value, -1)
+    if size < 0:
+        print(f"Invalid cache size: {value}", file=sys.stderr)
+        sys.exit(1)
+    context["cache_size"] = size
 
-    jlist = []
-    for jobset in jobsets:
-        jlist.append(jobset.find("a", {"class": "row-link"})["href"].split("/")[-1])
 
-    hlist = []
-    for jobset in hiddens:
-        hlist.append(jobset.find("a", {"class": "row-link"})["href"].split("/")[-1])
+def cacheage_e(context, value):
+    """Set maximum age of mutable page cache entries in context
 
-    dlist = []
-    for jobset in disableds:
-        dlist.append(jobset.find("a", {"class": "row-link"})["href"].split("/")[-1])
+    @param context: Connection context
+    @param value: Maximum age in days
+    """
+    age = convert_int(value, -1)
+    if age < 0:
+        print(f"Invalid cache age: {value}", file=sys.stderr)
+        sys.exit(1)
+    context["cache_age"] = age
 
-    if context["hid_jobset"] is False:
-        for jobset in hlist:
-            if jobset in jlist:
-                jlist.remove(jobset)
 
-    if context["dis_jobset"] is False:
-        for jobset in dlist:
-            if jobset in jlist:
-                jlist.remove(jobset)
+def parallel_e(context, value):
+    """Set number of concurrent actions in context
 
+    @param context: Connection context
+    @param value: Number of concurrent actions
+    """
+    context["parallel"] = positive_int("number of actions", value)
     if DEBUG:
-        print("Found jobsets: ", jlist)
+        print(f"Running up to {value} actions concurrently")
 
-    return jlist
 
+def timeout_e(context, value):
+    """Set action timeout in context
 
-def handle_jobset(context, project, jobset, handled):
-    """Handles a given jobset of given project
+    @param context: Connection context
+    @param value: Timeout in seconds
+    """
+    context["timeout"] = positive_int("timeout", value)
+
+
+def projectlimit_e(context, value):
+    """Set maximum number of concurrent actions per project in context
 
     @param context: Connection context
-    @param project: Project name
-    @param jobset: Jobset name
-    @param handled: list of handled builds
+    @param value: Number of concurrent actions
     """
-    # It is assumed here that all evaluations containing builds that need processing
-    # are found on the first page of evaluations listing
-    text = get_page(context, f"{context['hydra_url']}jobset/{project}/{jobset}")
+    context["project_limit"] = positive_int("project limit", value)
 
-    soup = bs4.BeautifulSoup(text, features="html.parser")
 
-    builds = []
-    for link in reversed(soup.find_all("a", {"class": "row-link"})):
-        # Could also use the link as-is, but just to be safe side we create new link
-        builds += get_builds(context, link.text)
+def evalpages_e(context, value):
+    """Set maximum number of evaluation listing pages per jobset in context
 
-    # Remove duplicates
-    builds = list(dict.fromkeys(builds))
+    @param context: Connection context
+    @param value: Number of pages
+    """
+    context["eval_pages"] = positive_int("number of evaluation pages", value)
 
-    new_handled = []
 
-    for i in builds:
-        if i not in handled:
-            binfo = get_build_info(context, i)
-            buildid = convert_int(binfo.get("Build ID"), -1)
+def discoveryttl_e(context, value):
+    """Set time to live of cached projects and jobsets in context
 
-            if buildid != i:
-                if DEBUG:
-                    print(
-                        f"Build ID mismatch: build id on page = {buildid}, "
-                        f"build id requested = {i}, skipping"
-                    )
-                continue
+    @param context: Connection context
+    @param value: Time to live in seconds, 0 disables caching
+    """
+    ttl = convert_int(value, -1)
+    if ttl < 0:
+        print(f"Invalid discovery TTL: {value}", file=sys.stderr)
+        sys.exit(1)
+    context["discovery_ttl"] = ttl
 
-            status = binfo.get("Status", "Unknown")
 
-            if status in ("Scheduled to be built", "Build in progress"):
-                if DEBUG:
-                    print(f"Build {i} not finished yet, skipping")
-                continue
+def plan_e(context):
+    """Enable plan mode, builds are only reported
 
-            if status == "Success":
-                # check postbuild status for succeeded builds only
-                runcmd_status = binfo["RunCommand status"]
-                if runcmd_status is None:
-                    if DEBUG:
-                        print(
-                            f"RunCommands for build {i} are not finished yet, skipping"
-                        )
-                    continue
+    @param context: Connection context
+    """
+    context["plan_en"] = True
 
-                elif runcmd_status != "Succeeded":
-                    # if there is a status but it was not success,
-                    # there is no need to retry later. just mark as handled.
-                    if DEBUG:
-                        print(
-                            f"RunCommands for build {i} {runcmd_status}, "
-                            "marking as handled"
-                        )
-                    new_handled.append(i)
-                    continue
 
-                binfo["Server"] = context["server"]
-                binfo["Project"] = project
-                binfo["Jobset"] = jobset
-                del binfo["Status"]
-                env = set_env(binfo)
-                if context["json_en"]:
-                    save_json(binfo)
-                if DEBUG:
-                    print(f"Handling {i} " + "-" * 60)
+def batch_e(context):
+    """Enable running action once for all builds of a scan
 
-                # Run the user specified action with build info in environment
-                result = subprocess.run(
-                    context["action"], shell=True, env=env, check=False
-                )
+    @param context: Connection context
+    """
+    context["batch"] = True
 
-                if result.returncode == 0:
-                    new_handled.append(i)
-                    if DEBUG:
-                        print("Handling successful " + "-" * 55)
-                else:
-                    if DEBUG:
-                        print(f"Action failed with code: {result.returncode}")
-            else:
-                if DEBUG:
-                    print(f"Build {i} has failed, just marking as handled")
-                new_handled.append(i)
-        else:
-            if DEBUG:
-                print(f"Build {i} already handled")
 
-    return new_handled
+def handoff_e(context):
+    """Enable passing build info to action in a JSON file
+
+    @param context: Connection context
+    """
+    context["handoff"] = True
 
 
-def main_locked(context):
-    """locked main program, called only if lock was aqcuired successfully
+def ndjson_e(context, value):
+    """Set NDJSON file of handled builds in context
 
     @param context: Connection context
+    @param value: File name
     """
-    context["hydra_url"] = f"https://{context['server']}/"
-    context["headers"] = {
-        "Accept": "text/html,application/xhtml+xml,application/xml;q=0.9,*/*;q=0.8",
-        "Accept-Encoding": "gzip, deflate",
-        "User-Agent": "hydrascraper.py v1.0",
-    }
+    context["ndjson_file"] = value
 
-    handled = get_handled(context["handled_file"])
 
-    projects = get_projects(context)
-    projects = list(filter(context["re_p"].match, projects))
-    if DEBUG:
-        print("Selected projects: ", projects)
+def metrics_e(context, value):
+    """Set statistics file in context
 
-    jobsets = {}
-    for proj in projects:
-        jobsets[proj] = get_jobsets(context, proj)
+    @param context: Connection context
+    @param value: File name, Prometheus text format is used if it ends with .prom
+    """
+    context["metrics_file"] = value
 
-    for proj in projects:
-        jobsets[proj] = list(filter(context["re_js"].match, jobsets[proj]))
-        if DEBUG:
-            print(f"{proj} selected jobsets: {jobsets[proj]}")
 
-    for project in projects:
-        for jobset in jobsets[project]:
-            handled += handle_jobset(context, project, jobset, handled)
+def prio_e(context, value):
+    """Add build priority pattern in context
 
-    update_handled(context["handled_file"], handled)
+    @param context: Connection context
+    @param value: REGEX=N, builds with project:jobset:job matching REGEX get
+                  priority N
+    """
+    pattern, _, prio = value.rpartition("=")
+    try:
+        context["priorities"].append((re.compile(pattern), int(prio)))
+    except ValueError:
+        print(f"Invalid priority: {value}, expected REGEX=N", file=sys.stderr)
+        sys.exit(1)
+    except re.error as error:
+        print(f"Regular expression error: {error.msg}", file=sys.stderr)
+        sys.exit(1)
 
 
-def json_e(context):
-    """Enable JSON output in context
+def retries_e(context, value):
+    """Set number of retries of failed requests in context
 
     @param context: Connection context
+    @param value: Number of retries, 0 disables retrying
     """
-    context["json_en"] = True
-    if DEBUG:
-        print("JSON enabled")
+    retries = convert_int(value, -1)
+    if retries < 0:
+        print(f"Invalid number of retries: {value}", file=sys.stderr)
+        sys.exit(1)
+    context["retries"] = retries
 
 
-def debug_e(_):
-    """Set global debug flag"""
-    global DEBUG
-    DEBUG = 1
-    print("Debug enabled")
+def maxrequests_e(context, value):
+    """Set maximum number of concurrent HTTP requests in context
 
+    @param context: Connection context
+    @param value: Number of requests
+    """
+    context["max_requests"] = positive_int("maximum requests", value)
 
-def hp_e(context):
-    """Set hidden projects flag in context
+
+def daemon_e(context):
+    """Enable daemon mode in context
 
     @param context: Connection context
     """
-    context["hid_proj"] = True
+    context["daemon"] = True
     if DEBUG:
-        print("Including hidden projects")
+        print("Daemon mode enabled")
 
 
-def dp_e(context):
-    """Set disabled projects flag in context
+def interval_e(context, value):
+    """Set minimum polling interval of daemon mode in context
 
     @param context: Connection context
+    @param value: Interval in seconds
     """
-    context["dis_proj"] = True
-    if DEBUG:
-        print("Including disabled projects")
+    context["min_interval"] = positive_int("interval", value)
 
 
-def hj_e(context):
-    """Set hidden jobsets flag in context
+def maxinterval_e(context, value):
+    """Set maximum polling interval of daemon mode in context
 
     @param context: Connection context
+    @param value: Interval in seconds
     """
-    context["hid_jobset"] = True
-    if DEBUG:
-        print("Including hidden jobsets")
+    context["max_interval"] = positive_int("maximum interval", value)
 
 
-def dj_e(context):
-    """Set disabled jobsets flag in context
+def trigger_e(context, value):
+    """Set port of the scan trigger endpoint in context
 
     @param context: Connection context
+    @param value: TCP port
     """
-    context["dis_jobset"] = True
-    if DEBUG:
-        print("Including disabled jobsets")
+    context["trigger_port"] = positive_int("trigger port", value)
 
 
-def main(argv):
-    """Main function
+def default_context():
+    """Gets a context with default settings
 
-    @param argv: Command line parameters
+    @return: Connection context
     """
-    global DEBUG
-    # Set debug if set in environment
-    DEBUG = convert_int(os.getenv("DEBUG"))
+    return {
+        "json_en": False,
+        "json_compact": False,
+        "ndjson_file": None,
+        "handoff": False,
+        "batch": False,
+        "plan_en": False,
+        "dis_proj": False,
+        "hid_proj": False,
+        "dis_jobset": False,
+        "hid_jobset": False,
+        "jobs": 4,
+        "backend": "html",
+        "scheme": "https",
+        "parser": "html.parser",
+        "cache_dir": None,
+        "cache_size": 1024,
+        "cache_age": 7,
+        "parallel": 1,
+        "timeout": None,
+        "project_limit": None,
+        "daemon": False,
+        "min_interval": 30,
+        "max_interval": 600,
+        "trigger_port": None,
+        "discovery_ttl": 300,
+        "eval_pages": 10,
+        "metrics_file": None,
+        "max_requests": None,
+        "retries": 3,
+        "priorities": [],
+    }
+
 
+def parse_options(context, options):
+    """Sets options in context
+
+    @param context: Connection context
+    @param options: List of command line options
+    """
     # Map options to functions setting the flags
     argfu = {
         "-json": json_e,
@@ -669,53 +3183,162 @@ def main(argv):
         "-dp": dp_e,
         "-hj": hj_e,
         "-dj": dj_e,
+        "-html": html_e,
+        "-jsonapi": jsonapi_e,
+        "-daemon": daemon_e,
+        "-http": http_e,
+        "-compact": compact_e,
+        "-handoff": handoff_e,
+        "-batch": batch_e,
+        "-plan": plan_e,
     }
 
-    # Default settings in context
-    context = {
-        "json_en": False,
-        "dis_proj": False,
-        "hid_proj": False,
-        "dis_jobset": False,
-        "hid_jobset": False,
+    # Map options taking a value to functions setting the values
+    argvalfu = {
+        "-jobs": jobs_e,
+        "-cache": cache_e,
+        "-cachesize": cachesize_e,
+        "-cacheage": cacheage_e,
+        "-parallel": parallel_e,
+        "-timeout": timeout_e,
+        "-projectlimit": projectlimit_e,
+        "-interval": interval_e,
+        "-maxinterval": maxinterval_e,
+        "-trigger": trigger_e,
+        "-discoveryttl": discoveryttl_e,
+        "-evalpages": evalpages_e,
+        "-metrics": metrics_e,
+        "-parser": parser_e,
+        "-ndjson": ndjson_e,
+        "-maxrequests": maxrequests_e,
+        "-retries": retries_e,
+        "-prio": prio_e,
     }
 
-    # Help user, too few arguments given
-    if len(argv) < 5:
-        send_help()
+    i = 0
+    while i < len(options):
+        func = argfu.get(options[i], None)
+        valfunc = argvalfu.get(options[i], None)
+        if func is not None:
+            func(context)
+        elif valfunc is not None:
+            if i + 1 >= len(options):
+                print(f"Missing value for argument: {options[i]}", file=sys.stderr)
+                sys.exit(1)
+            i += 1
+            valfunc(context, options[i])
+        else:
+            print(f"Invalid argument: {options[i]}", file=sys.stderr)
+            sys.exit(1)
+        i += 1
+
 
-    context["server"] = argv[0]
+def set_target(context, server, project_re, jobset_re, handled_file, action):
+    """Sets server, searched projects and jobsets and handling of builds
+    in context
+
+    @param context: Connection context
+    @param server: Hydra server
+    @param project_re: Regular expression of project names
+    @param jobset_re: Regular expression of jobset names
+    @param handled_file: Handled builds file
+    @param action: Action to run for each build
+    """
+    # pylint: disable=too-many-arguments
+    context["server"] = server
 
     regexes = []
-    for i in [0, 1]:
+    for regex in [project_re, jobset_re]:
         try:
             # Create regular expression objects of project and jobset strings
-            regexes.append(re.compile(argv[i + 1]))
+            regexes.append(re.compile(regex))
         except re.error as error:
             if error.pos is not None:
-                print(argv[i + 1], file=sys.stderr)
+                print(regex, file=sys.stderr)
                 print(" " * error.pos + "^", file=sys.stderr)
             print(f"Regular expression error: {error.msg}", file=sys.stderr)
             sys.exit(1)
 
     context["re_p"] = regexes[0]
     context["re_js"] = regexes[1]
-    context["handled_file"] = argv[3]
-    context["action"] = argv[4]
-
-    if len(argv) > 5:
-        # Process options
-        for i in range(5, len(argv)):
-            func = argfu.get(argv[i], None)
-            if func is not None:
-                func(context)
-            else:
-                print(f"Invalid argument: {argv[i]}", file=sys.stderr)
-                sys.exit(1)
+    context["handled_file"] = handled_file
+    context["action"] = action
+
+
+def load_config(filename, options):
+    """Creates contexts for the targets listed in a config file
+
+    Config file is a JSON object with a list of targets, each having server,
+    projects, jobsets, handled and action keys matching the command line
+    arguments, and optionally a list of options overriding the command line
+    options for the target.
+
+    @param filename: Config file name
+    @param options: List of command line options
+
+    @return: list of contexts
+    """
+    try:
+        with open(filename, "r", encoding="utf-8") as config_file:
+            config = json.load(config_file)
+    except OSError as error:
+        print(f"Could not read {filename}: {error.strerror}", file=sys.stderr)
+        sys.exit(1)
+    except ValueError as error:
+        print(f"Invalid config file {filename}: {error}", file=sys.stderr)
+        sys.exit(1)
+
+    targets = config.get("targets") if isinstance(config, dict) else None
+    if not isinstance(targets, list) or len(targets) == 0:
+        print(f"No targets in config file {filename}", file=sys.stderr)
+        sys.exit(1)
+
+    contexts = []
+    for index, target in enumerate(targets):
+        try:
+            args = [
+                target[key]
+                for key in ("server", "projects", "jobsets", "handled", "action")
+            ]
+        except (KeyError, TypeError):
+            print(
+                f"Target {index} in {filename} needs server, projects, jobsets, "
+                "handled and action",
+                file=sys.stderr,
+            )
+            sys.exit(1)
+
+        context = default_context()
+        parse_options(context, options)
+        parse_options(context, target.get("options", []))
+        set_target(context, *args)
+        contexts.append(context)
+
+    handled_files = [os.path.abspath(context["handled_file"]) for context in contexts]
+    if len(set(handled_files)) != len(handled_files):
+        print(f"Targets in {filename} share a handled builds file", file=sys.stderr)
+        sys.exit(1)
 
-    lock = filelock.FileLock(f"{argv[3]}.lock")
+    return contexts
+
+
+def run_target(context):
+    """Runs main program for a target holding the lock of its handled builds file
+
+    @param context: Connection context
+    """
+    lock = filelock.FileLock(f"{context['handled_file']}.lock")
     try:
         lock.acquire(timeout=0)
+        context["json_writer"] = JsonWriter(
+            (
+                context["server"]
+                if context["json_en"] and not context["plan_en"]
+                else None
+            ),
+            context["json_compact"],
+            context["ndjson_file"],
+        )
         main_locked(context)
 
     except filelock.Timeout as timeout:
@@ -728,13 +3351,112 @@ def main(argv):
 
     except PermissionError as perm_error:
         print(
-            f"Could not aquire {argv[3]}.lock: {perm_error.strerror}", file=sys.stderr
+            f"Could not aquire {context['handled_file']}.lock: {perm_error.strerror}",
+            file=sys.stderr,
         )
 
+    except FetchError as error:
+        # Scan is not completed, so state is not updated and nothing is lost
+        print(f"Scan failed: {error}", file=sys.stderr)
+        sys.exit(1)
+
     finally:
         lock.release()
 
 
+def run_targets(contexts):
+    """Runs targets concurrently, each in its own thread
+
+    @param contexts: List of contexts
+
+    @return: True if all targets were run without errors
+    """
+    failed = []
+
+    def run(context):
+        try:
+            run_target(context)
+        except BaseException:
+            failed.append(context["server"])
+            raise
+
+    # Daemon threads, so that the process can exit on termination
+    # while the targets are still running in daemon mode
+    threads = [
+        threading.Thread(target=run, args=(context,), daemon=True)
+        for context in contexts
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    for server in failed:
+        print(f"Handling of {server} failed", file=sys.stderr)
+    return len(failed) == 0
+
+
+def main(argv):
+    """Main function
+
+    @param argv: Command line parameters
+    """
+    global DEBUG
+    # Set debug if set in environment
+    DEBUG = convert_int(os.getenv("DEBUG"))
+
+    # Command line options are the global settings, and in config file mode
+    # the defaults of the targets
+    settings = default_context()
+    if len(argv) >= 2 and argv[0] == "-config":
+        parse_options(settings, argv[2:])
+        contexts = load_config(argv[1], argv[2:])
+    else:
+        # Help user, too few arguments given
+        if len(argv) < 5:
+            send_help()
+        parse_options(settings, argv[5:])
+        set_target(settings, *argv[:5])
+        contexts = [settings]
+
+    # Connections, cache directories, action slots and scan trigger are
+    # shared by all targets
+    client = HttpClient(
+        max_requests=settings["max_requests"], retries=settings["retries"]
+    )
+    action_slots = threading.Semaphore(settings["parallel"])
+    caches = {}
+    for context in contexts:
+        context["client"] = client
+        context["action_slots"] = action_slots
+        context["trigger"] = threading.Event()
+        if context["cache_dir"] is not None:
+            if context["cache_dir"] not in caches:
+                caches[context["cache_dir"]] = PageCache(
+                    context["cache_dir"],
+                    context["cache_size"] * 1024 * 1024,
+                    context["cache_age"] * 24 * 60 * 60,
+                )
+            context["cache"] = caches[context["cache_dir"]]
+
+    if any(context["daemon"] for context in contexts):
+        # Exit cleanly and release the locks on termination
+        signal.signal(signal.SIGTERM, lambda *_: sys.exit(0))
+        if settings["trigger_port"] is not None:
+            start_trigger_server(
+                settings["trigger_port"], [context["trigger"] for context in contexts]
+            )
+
+    try:
+        if len(contexts) == 1:
+            run_target(contexts[0])
+        elif not run_targets(contexts):
+            sys.exit(1)
+
+    finally:
+        client.close()
+
+
 # Run main when executed from command line
 if __name__ == "__main__":
     main(sys.argv[1:])